@@ -0,0 +1,267 @@
+import os
+import time
+import traceback
+import uuid
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import SimpleITK as Sitk
+
+from dicom_utilities import RegistrationHelper, VolumeCache
+from instrumentation import Instrumentation
+
+# A single moving -> fixed registration that has to be performed.
+RegistrationPair = namedtuple('RegistrationPair', ['patient', 'moving_dir', 'fixed_dir', 'output_dir', 'output_name'])
+
+# Outcome of a registration pair, error is None when everything went fine.
+RegistrationResult = namedtuple('RegistrationResult', ['pair', 'error', 'elapsed'])
+
+
+# Cache of the fixed images of the worker process, created by _init_worker,
+# and patient of the last task, the cache is cleared when it changes.
+_worker_cache = None
+_worker_patient = None
+
+
+# Called once in every worker process, limits the number of threads that
+# SimpleITK spawns for each filter so that the workers don't fight for the cores.
+def _init_worker(sitk_threads, cache_bytes):
+    global _worker_cache
+
+    Sitk.ProcessObject_SetGlobalDefaultNumberOfThreads(sitk_threads)
+    _worker_cache = VolumeCache(cache_bytes) if cache_bytes else None
+    # Workers have no display, the plots must not open any window. matplotlib
+    # is imported lazily, the backend is chosen when it is imported.
+    os.environ['MPLBACKEND'] = 'Agg'
+
+
+# Registers a single pair and never raises, the error is reported in the result.
+# The stages of the pair are recorded with the options of Instrumentation.
+def _register_pair(pair, helper_options, registration_options, instrumentation_options):
+    start = time.time()
+    error = None
+    instrumentation = Instrumentation(**instrumentation_options, patient=pair.patient, pair=pair.output_name)
+
+    try:
+        os.makedirs(pair.output_dir, exist_ok=True)
+        with instrumentation.profile(pair.output_name):
+            RegistrationHelper(pair.moving_dir,
+                               pair.fixed_dir,
+                               pair.output_dir,
+                               pair.output_name,
+                               cache=_worker_cache,
+                               instrumentation=instrumentation,
+                               **helper_options).start_coregistration(**registration_options)
+    except Exception:
+        error = traceback.format_exc()
+
+    elapsed = time.time() - start
+    instrumentation.event('pair', seconds=elapsed, error=error)
+    return RegistrationResult(pair, error, elapsed)
+
+
+# Registers a group of pairs in the same worker, one after the other. The fixed
+# images of the previous patient are dropped first, a worker never keeps them
+# after moving to the next patient.
+def _register_pairs(pairs, helper_options, registration_options, instrumentation_options):
+    global _worker_patient
+
+    if _worker_cache is not None and pairs and pairs[0].patient != _worker_patient:
+        _worker_cache.clear()
+        _worker_patient = pairs[0].patient
+
+    return [_register_pair(pair, helper_options, registration_options, instrumentation_options) for pair in pairs]
+
+
+# Helper class that runs the coregistration of many patients in parallel
+# using a pool of processes.
+class BatchRegistration:
+
+    SCHEDULE_PATIENT = 'patient'
+    SCHEDULE_PAIR = 'pair'
+
+    # Initialization method of the class.
+    # workers: number of processes, defaults to the number of cores.
+    # sitk_threads: number of threads used by SimpleITK inside each worker.
+    # schedule: 'patient' sends all the pairs of a patient to the same worker,
+    #           'pair' sends every pair to the first free worker.
+    # max_pending: maximum number of tasks submitted at the same time, it bounds
+    #              the memory used by the queued tasks and their results.
+    # max_tasks_per_child: recycles the workers after this many tasks, to give
+    #                      back to the system the memory held by ITK.
+    # cache_bytes: size of the fixed image cache of each worker, 0 disables it.
+    #              The cache only keeps the fixed images of the current patient
+    #              (usually one volume), so with the 'patient' schedule each fixed
+    #              image is decoded once. In the worst case every worker holds
+    #              cache_bytes on top of the registration, i.e. workers * cache_bytes.
+    # log_path: JSONL file where the workers append the stages of every pair,
+    #           see instrumentation.summarize.
+    # profile_dir: folder of the cProfile statistics of every pair, the pairs
+    #              are not profiled when it is None.
+    # helper_options: arguments of RegistrationHelper, e.g. profile and pixel_types.
+    # registration_options: arguments of RegistrationHelper.start_coregistration,
+    #                       the workers have no display so plot is False by default.
+    def __init__(self, workers=None, sitk_threads=1, schedule=SCHEDULE_PAIR,
+                 max_pending=None, max_tasks_per_child=None, cache_bytes=512 * 1024 ** 2,
+                 log_path=None, profile_dir=None, helper_options=None, **registration_options):
+        if schedule not in (self.SCHEDULE_PATIENT, self.SCHEDULE_PAIR):
+            raise ValueError(f'Unknown schedule {schedule}, use "patient" or "pair".')
+
+        self.workers = workers or os.cpu_count() or 1
+        self.sitk_threads = sitk_threads
+        self.schedule = schedule
+        self.max_pending = max_pending or 2 * self.workers
+        self.max_tasks_per_child = max_tasks_per_child
+        self.cache_bytes = cache_bytes
+        self.instrumentation_options = {'log_path': log_path, 'profile_dir': profile_dir}
+        # Id of the last run, written in all its events, see instrumentation.read_events.
+        self.run_id = None
+        self.helper_options = helper_options or {}
+        self.registration_options = dict(registration_options)
+        self.registration_options.setdefault('plot', False)
+
+    # Builds the list of pairs from the nested dictionary returned by
+    # OPBGExplorer.load_patients, the fixed sequence of each patient
+    # is the one with the most slices.
+    @staticmethod
+    def pairs_from_patients(patients, patients_dir, output_dir):
+        pairs = []
+
+        for patient, seqs in patients.items():
+            if not seqs:
+                continue
+
+            fixed = max(seqs, key=seqs.get)
+            out_study_dir = os.path.join(output_dir, patient)
+
+            for moving in seqs:
+                pairs.append(RegistrationPair(patient,
+                                              os.path.join(patients_dir, patient, moving),
+                                              os.path.join(patients_dir, patient, fixed),
+                                              out_study_dir,
+                                              f'{patient}_coreg_{moving}'))
+
+        return pairs
+
+    # Groups the pairs in the tasks that will be submitted to the pool.
+    def _tasks(self, pairs):
+        if self.schedule == self.SCHEDULE_PAIR:
+            return [[pair] for pair in pairs]
+
+        by_patient = {}
+        for pair in pairs:
+            by_patient.setdefault(pair.patient, []).append(pair)
+
+        # Biggest patients first, so that they don't end up alone at the end of the run.
+        return sorted(by_patient.values(), key=len, reverse=True)
+
+    # Returns the results of the pairs of a task that could not be registered.
+    def _failed(self, task, error):
+        for pair in task:
+            instrumentation = Instrumentation(**self.instrumentation_options,
+                                              patient=pair.patient, pair=pair.output_name)
+            instrumentation.event('pair', seconds=0.0, error=error)
+        return [RegistrationResult(pair, error, 0.0) for pair in task]
+
+    # Returns the results of a finished task, BrokenProcessPool is raised
+    # when the pool broke before the task was finished.
+    def _task_results(self, future, task):
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            raise
+        except Exception:
+            # E.g. a result that can't be sent back to the main process.
+            return self._failed(task, traceback.format_exc())
+
+    # Runs the queued tasks in a new pool until the queue is empty or a worker
+    # dies. A dead worker (e.g. killed for memory or crashed in ITK) breaks the
+    # whole pool, the tasks that were still running are returned as lost.
+    # queue: deque of (task, suspect), a suspect task was running when a pool
+    #        broke and runs alone, so that it is the cause if this pool breaks.
+    def _run_pool(self, queue, add_results):
+        executor_options = {'max_workers': self.workers,
+                            'initializer': _init_worker,
+                            'initargs': (self.sitk_threads, self.cache_bytes)}
+        if self.max_tasks_per_child:
+            executor_options['max_tasks_per_child'] = self.max_tasks_per_child
+
+        with ProcessPoolExecutor(**executor_options) as executor:
+            pending = {}
+
+            try:
+                while True:
+                    # Keep at most max_pending tasks in the pool.
+                    while queue and len(pending) < self.max_pending:
+                        task, suspect = queue[0]
+                        if pending and (suspect or any(suspect for _, suspect in pending.values())):
+                            break
+                        pending[executor.submit(_register_pairs, task, self.helper_options,
+                                                self.registration_options,
+                                                self.instrumentation_options)] = task, suspect
+                        queue.popleft()
+
+                    if not pending:
+                        return []
+
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+                    for future in done:
+                        add_results(self._task_results(future, pending[future][0]))
+                        del pending[future]
+            except BrokenProcessPool:
+                pass
+
+            # The pool is broken, the tasks finished before it broke still have their results.
+            lost = []
+            for future, (task, suspect) in pending.items():
+                try:
+                    add_results(self._task_results(future, task))
+                except BrokenProcessPool:
+                    lost.append((task, suspect, traceback.format_exc()))
+            return lost
+
+    # Runs all the pairs and returns the list of results, on_result is
+    # called in the main process every time a pair is finished. When a worker
+    # dies the pool is replaced and the tasks that were running in it are
+    # submitted again one at a time: a pair that breaks the pool while it
+    # runs alone is reported as failed, the run goes on with the others.
+    def run(self, pairs, on_result=None):
+        self.run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.instrumentation_options['run'] = self.run_id
+        queue = deque((task, False) for task in self._tasks(pairs))
+        results = []
+
+        def add_results(task_results):
+            for result in task_results:
+                results.append(result)
+                if on_result is not None:
+                    on_result(result)
+
+        while queue:
+            lost = self._run_pool(queue, add_results)
+
+            retry = []
+            for task, suspect, error in lost:
+                if not suspect:
+                    retry.append((task, True))
+                elif len(task) > 1:
+                    # One of the pairs of the task killed the worker, they run one by one.
+                    retry.extend(([pair], True) for pair in task)
+                else:
+                    add_results(self._failed(task, error))
+            queue.extendleft(reversed(retry))
+
+        return results
+
+    # Prints a small report of the run.
+    @staticmethod
+    def print_report(results):
+        failed = [result for result in results if result.error is not None]
+        elapsed = sum(result.elapsed for result in results)
+
+        print(f'Registered {len(results) - len(failed)}/{len(results)} pairs in {round(elapsed, 2)}s of worker time.')
+        for result in failed:
+            print(f'Failed {result.pair.patient} {result.pair.output_name}:')
+            print(result.error)
@@ -0,0 +1,433 @@
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count
+
+import numpy as np
+from numpy import linalg
+import SimpleITK as sitk
+
+import registration_utilities as ru
+from instrumentation import peak_rss_mb
+
+# Sequences of the synthetic patients, the first one is the fixed image.
+SYNTHETIC_SEQUENCES = ('t1', 't2', 'flair')
+
+
+# Returns the best time of a few runs of a function.
+def best_time(function, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+# Original point by point version of registration_errors, without display.
+def registration_errors_per_point(tx, reference_fixed_point_list, reference_moving_point_list):
+    transformed_fixed_point_list = [tx.TransformPoint(p) for p in reference_fixed_point_list]
+    errors = [linalg.norm(np.array(p_fixed) - np.array(p_moving))
+              for p_fixed, p_moving in zip(transformed_fixed_point_list, reference_moving_point_list)]
+    return np.mean(errors), np.std(errors), np.min(errors), np.max(errors), errors
+
+
+# Original point by point version of generate_random_pointset.
+def generate_random_pointset_per_point(image, num_points):
+    point_indexes = np.multiply(np.tile(image.GetSize(), (num_points, 1)),
+                                np.random.random((num_points, image.GetDimension())))
+    return [image.TransformContinuousIndexToPhysicalPoint(point_index) for point_index in point_indexes.tolist()]
+
+
+# Compares the point by point and the vectorized point transforms of
+# registration_utilities, returns the timings in seconds, the speedups and the
+# largest difference in mm between the errors of the two versions.
+def benchmark_point_transforms(num_points=50000, image_size=(256, 256, 160)):
+    image = sitk.Image(image_size, sitk.sitkUInt8)
+    image.SetSpacing((0.9, 0.9, 1.2))
+
+    center = image.TransformContinuousIndexToPhysicalPoint([size / 2 for size in image_size])
+    transforms = {'euler': sitk.Euler3DTransform(center, 0.05, -0.03, 0.08, (4.0, -3.0, 2.5))}
+    bspline = sitk.BSplineTransformInitializer(image, [4, 4, 4])
+    bspline.SetParameters((np.random.random(len(bspline.GetParameters())) * 2).tolist())
+    transforms['bspline'] = bspline
+
+    # Grid of the displacement field of the non linear transforms, it has to be
+    # much coarser than the image to be faster than the point by point version.
+    reference_image = ru.coarse_grid(image, 4)
+
+    # The bspline is the identity outside of the centers of the border pixels,
+    # the points are inside them so that the errors of the two versions match.
+    fixed_points = ru.continuous_index_to_physical_points(
+        image, np.random.random((num_points, 3)) * (np.array(image_size) - 1))
+    fixed_point_list = [tuple(point) for point in fixed_points]
+    moving_points = fixed_points + np.random.normal(0, 1, fixed_points.shape)
+    moving_point_list = [tuple(point) for point in moving_points]
+
+    results = {'num_points': num_points,
+               'pointset_per_point': best_time(lambda: generate_random_pointset_per_point(image, num_points)),
+               'pointset_vectorized': best_time(lambda: ru.generate_random_points(image, num_points))}
+
+    for name, tx in transforms.items():
+        results[f'errors_{name}_per_point'] = best_time(
+            lambda: registration_errors_per_point(tx, fixed_point_list, moving_point_list))
+        results[f'errors_{name}_vectorized'] = best_time(
+            lambda: ru.registration_errors(tx, fixed_points, moving_points, reference_image=reference_image))
+        results[f'errors_{name}_speedup'] = (results[f'errors_{name}_per_point'] /
+                                             results[f'errors_{name}_vectorized'])
+
+        errors = registration_errors_per_point(tx, fixed_point_list, moving_point_list)[4]
+        vectorized_errors = ru.registration_errors(tx, fixed_points, moving_points,
+                                                   reference_image=reference_image)[4]
+        results[f'errors_{name}_max_difference_mm'] = float(np.max(np.abs(np.subtract(errors,
+                                                                                      vectorized_errors))))
+
+    return results
+
+
+# Compares absolute_orientation_m called in a loop with absolute_orientation_batch,
+# returns the timings in seconds and the largest difference between the results.
+def benchmark_absolute_orientation(batch_size=2000, num_points=8):
+    left = np.random.normal(0, 50, (batch_size, num_points, 3))
+    rotations = np.array([sitk.VersorTransform(tuple(axis), angle).GetMatrix()
+                          for axis, angle in zip(np.random.normal(size=(batch_size, 3)),
+                                                 np.random.uniform(-np.pi, np.pi, batch_size))])
+    right = np.einsum('bij,bnj->bni', rotations.reshape(-1, 3, 3), left) + np.random.normal(0, 0.5, left.shape)
+
+    loop_results = [ru.absolute_orientation_m(left[b], right[b]) for b in range(batch_size)]
+    R, t = ru.absolute_orientation_batch(left, right)
+
+    return {'batch_size': batch_size,
+            'absolute_orientation_loop': best_time(
+                lambda: [ru.absolute_orientation_m(left[b], right[b]) for b in range(batch_size)]),
+            'absolute_orientation_batch': best_time(lambda: ru.absolute_orientation_batch(left, right)),
+            'absolute_orientation_max_difference': max(np.abs(R - np.array([r for r, _ in loop_results])).max(),
+                                                       np.abs(t - np.array([t for _, t in loop_results])).max())}
+
+
+# Returns a synthetic head: an ellipsoid with an inner lesion and noise, int16
+# as the dicom series, with different contrasts for every sequence.
+def synthetic_volume(size=(128, 128, 64), spacing=(1.0, 1.0, 2.0), contrast=1.0, seed=0):
+    rng = np.random.default_rng(seed)
+    z, y, x = np.ogrid[-1:1:size[2] * 1j, -1:1:size[1] * 1j, -1:1:size[0] * 1j]
+
+    head = (x / 0.8) ** 2 + (y / 0.9) ** 2 + (z / 0.85) ** 2 <= 1
+    brain = (x / 0.7) ** 2 + (y / 0.8) ** 2 + (z / 0.75) ** 2 <= 1
+    lesion = ((x - 0.2) / 0.15) ** 2 + ((y + 0.1) / 0.2) ** 2 + (z / 0.2) ** 2 <= 1
+
+    array = 300 * head + 500 * contrast * brain + 400 * (2 - contrast) * lesion
+    array = array + rng.normal(0, 20, array.shape)
+
+    image = sitk.GetImageFromArray(array.astype(np.int16))
+    image.SetSpacing(spacing)
+    return image
+
+
+# Writes an image as a dicom series, one file per slice.
+def write_dicom_series(image, series_dir, patient, series_number):
+    os.makedirs(series_dir, exist_ok=True)
+    series_uid = f'1.2.826.0.1.3680043.2.1125.{zlib.crc32(patient.encode())}.{series_number}'
+    direction = image.GetDirection()
+
+    writer = sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    for k in range(image.GetDepth()):
+        image_slice = image[:, :, k]
+        tags = {'0010|0010': patient,
+                '0010|0020': patient,
+                '0020|000d': series_uid.rsplit('.', 1)[0],
+                '0020|000e': series_uid,
+                '0020|0011': str(series_number),
+                '0008|0060': 'MR',
+                '0018|1030': f'SEQ{series_number}',
+                '0020|0013': str(k + 1),
+                '0008|0018': f'{series_uid}.{k + 1}',
+                '0020|0032': '\\'.join(map(str, image.TransformIndexToPhysicalPoint((0, 0, k)))),
+                '0020|0037': '\\'.join(map(str, direction[0:9:3] + direction[1:9:3]))}
+        for tag, value in tags.items():
+            image_slice.SetMetaData(tag, value)
+        writer.SetFileName(os.path.join(series_dir, f'{k:04d}.dcm'))
+        writer.Execute(image_slice)
+
+
+# Generates root_dir/dicom/patient/sequence dicom series and the same volumes
+# as root_dir/nifti/patient/sequence.nii.gz. The moving sequences are rotated
+# and translated versions of the first one. Returns the list of patients.
+def generate_dataset(root_dir, patients=2, size=(128, 128, 64), sequences=SYNTHETIC_SEQUENCES):
+    names = [f'PAT{i:03d}' for i in range(patients)]
+
+    for p, patient in enumerate(names):
+        fixed = synthetic_volume(size, seed=p)
+        center = fixed.TransformContinuousIndexToPhysicalPoint([(s - 1) / 2 for s in size])
+
+        for s, sequence in enumerate(sequences):
+            image = synthetic_volume(size, contrast=1.0 - 0.3 * s, seed=p * 10 + s)
+            if s:
+                transform = sitk.Euler3DTransform(center, 0.04 * s, -0.03, 0.05, (3.0 * s, -2.0, 1.5))
+                image = sitk.Resample(image, image, transform, sitk.sitkLinear, 0, image.GetPixelID())
+
+            write_dicom_series(image, os.path.join(root_dir, 'dicom', patient, sequence), patient, s + 1)
+            os.makedirs(os.path.join(root_dir, 'nifti', patient), exist_ok=True)
+            sitk.WriteImage(image, os.path.join(root_dir, 'nifti', patient, f'{sequence}.nii.gz'))
+
+    return names
+
+
+# Stages of the suite, every one runs in a new process on the generated dataset
+# and returns the seconds spent and its own measures. The peak memory is the one
+# of the process of the stage.
+
+def stage_read_dicom(data_dir, options):
+    from dicom_utilities import RegistrationHelper
+
+    series_dirs = [os.path.join(data_dir, 'dicom', patient, sequence)
+                   for patient in options['patients'] for sequence in SYNTHETIC_SEQUENCES]
+    helper = RegistrationHelper(None, None, None, None)
+    start = time.perf_counter()
+    voxels = sum(np.prod(helper.read_dicom_series(series_dir).GetSize()) for series_dir in series_dirs)
+    return {'seconds': time.perf_counter() - start, 'volumes': len(series_dirs), 'voxels': int(voxels)}
+
+
+def stage_read_nifti(data_dir, options):
+    from volume_store import read_image
+
+    paths = [os.path.join(data_dir, 'nifti', patient, f'{sequence}.nii.gz')
+             for patient in options['patients'] for sequence in SYNTHETIC_SEQUENCES]
+    start = time.perf_counter()
+    for path in paths:
+        read_image(path)
+    return {'seconds': time.perf_counter() - start, 'volumes': len(paths)}
+
+
+def stage_write_nifti(data_dir, options):
+    from volume_store import write_image_nifti
+
+    image = sitk.ReadImage(os.path.join(data_dir, 'nifti', options['patients'][0], f'{SYNTHETIC_SEQUENCES[0]}.nii.gz'))
+    output_dir = os.path.join(data_dir, 'written')
+    os.makedirs(output_dir, exist_ok=True)
+
+    results = {}
+    for name, write in (('sitk', lambda path: sitk.WriteImage(image, path)),
+                        ('write_image_nifti', lambda path: write_image_nifti(image, path))):
+        # Both writers are timed warm, the first write imports nibabel.
+        write(os.path.join(output_dir, f'{name}_warmup.nii'))
+        for extension in ('.nii', '.nii.gz'):
+            start = time.perf_counter()
+            write(os.path.join(output_dir, f'{name}{extension}'))
+            results[f'{name}{extension}_seconds'] = time.perf_counter() - start
+    results['seconds'] = sum(results.values())
+    return results
+
+
+def stage_register(data_dir, options):
+    from dicom_utilities import RegistrationHelper
+
+    output_dir = os.path.join(data_dir, 'registered')
+    os.makedirs(output_dir, exist_ok=True)
+
+    totals = {}
+    start = time.perf_counter()
+    for patient in options['patients']:
+        patient_dir = os.path.join(data_dir, 'dicom', patient)
+        for sequence in SYNTHETIC_SEQUENCES[1:]:
+            helper = RegistrationHelper(os.path.join(patient_dir, sequence),
+                                        os.path.join(patient_dir, SYNTHETIC_SEQUENCES[0]),
+                                        output_dir, f'{patient}_{sequence}', profile=options['profile'])
+            helper.start_coregistration(save_on_disk=True, file_extension='.nii', plot=False)
+            for stage in ('read_seconds', 'registration_seconds', 'resample_seconds'):
+                totals[stage] = totals.get(stage, 0.0) + helper.report.get(stage, 0.0)
+
+    return dict(totals, seconds=time.perf_counter() - start,
+                pairs=len(options['patients']) * (len(SYNTHETIC_SEQUENCES) - 1))
+
+
+def stage_index(data_dir, options):
+    from dicom_index import DicomIndex
+
+    index_path = os.path.join(data_dir, 'index.sqlite')
+    with DicomIndex(index_path, os.path.join(data_dir, 'dicom')) as index:
+        start = time.perf_counter()
+        index.build()
+        build_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        index.update()
+        update_seconds = time.perf_counter() - start
+        files = len(index.records())
+
+    return {'seconds': build_seconds, 'update_seconds': update_seconds, 'files': files}
+
+
+def stage_organize(data_dir, options):
+    from dicom_index import DicomIndex
+    from organizer import DatasetOrganizer
+
+    output_dir = os.path.join(data_dir, 'organized')
+    shutil.rmtree(output_dir, ignore_errors=True)
+    with DicomIndex(os.path.join(data_dir, 'organize_index.sqlite'), os.path.join(data_dir, 'dicom')) as index:
+        start = time.perf_counter()
+        counts = DatasetOrganizer(output_dir, strategy=DatasetOrganizer.HARDLINK).organize(index.scan())
+    return dict(counts, seconds=time.perf_counter() - start)
+
+
+def stage_convert(data_dir, options):
+    from dicom_conversion import DicomConverter
+    from dicom_index import DicomIndex
+
+    with DicomIndex(os.path.join(data_dir, 'index.sqlite'), os.path.join(data_dir, 'dicom')) as index:
+        index.update()
+        records = index.records()
+
+    output_dir = os.path.join(data_dir, 'converted')
+    shutil.rmtree(output_dir, ignore_errors=True)
+    start = time.perf_counter()
+    counts = DicomConverter(output_dir, workers=options['workers']).convert(records)
+    return dict(counts, seconds=time.perf_counter() - start)
+
+
+def stage_extract(data_dir, options):
+    from radiomics_extraction import ExtractionTask, RadiomicsExtraction
+
+    if importlib.util.find_spec('radiomics') is None:
+        return {'unavailable': 'pyradiomics is not installed'}
+
+    # The lesion of the synthetic volumes is the segmentation.
+    tasks = []
+    for patient in options['patients']:
+        patient_dir = os.path.join(data_dir, 'nifti', patient)
+        image_path = os.path.join(patient_dir, f'{SYNTHETIC_SEQUENCES[0]}.nii.gz')
+        label_path = os.path.join(patient_dir, 'seg.nii.gz')
+        label = sitk.BinaryThreshold(sitk.ReadImage(image_path), 1000, 10000)
+        sitk.WriteImage(sitk.Cast(label, sitk.sitkUInt8), label_path)
+        tasks.append(ExtractionTask(patient, {SYNTHETIC_SEQUENCES[0]: image_path}, label_path, {}))
+
+    output_path = os.path.join(data_dir, 'features.csv')
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    extraction = RadiomicsExtraction(output_path, workers=options['workers'])
+    start = time.perf_counter()
+    extraction.run(tasks)
+    return dict(extraction.timing_summary(), seconds=time.perf_counter() - start, subjects=len(tasks))
+
+
+def stage_classify(data_dir, options):
+    from mcc_evaluation import MCCEvaluation
+
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(280, 400)).astype(np.float32)
+    labels = (rng.random(280) < 0.7).astype(np.int8)
+    x[labels == 1, :20] += 0.5
+
+    evaluation = MCCEvaluation(x, labels, n_splits=options['splits'], workers=options['workers'])
+    evaluation.run()
+    return {'seconds': evaluation.seconds, 'splits': options['splits'],
+            'splits_per_second': evaluation.splits_per_second()}
+
+
+def stage_point_transforms(data_dir, options):
+    start = time.perf_counter()
+    results = benchmark_point_transforms()
+    return dict(results, seconds=time.perf_counter() - start)
+
+
+def stage_absolute_orientation(data_dir, options):
+    start = time.perf_counter()
+    results = benchmark_absolute_orientation()
+    return dict(results, seconds=time.perf_counter() - start)
+
+
+STAGES = {'read_dicom': stage_read_dicom,
+          'read_nifti': stage_read_nifti,
+          'write_nifti': stage_write_nifti,
+          'register': stage_register,
+          'index': stage_index,
+          'organize': stage_organize,
+          'convert': stage_convert,
+          'extract': stage_extract,
+          'classify': stage_classify,
+          'point_transforms': stage_point_transforms,
+          'absolute_orientation': stage_absolute_orientation}
+
+
+def _run_stage(name, data_dir, options):
+    results = STAGES[name](data_dir, options)
+    results['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+# Runs the stages of the suite, each one in a new process, and returns the
+# results with the description of the machine and of the dataset.
+def run_suite(stages=None, size=(128, 128, 64), patients=2, profile='fast', workers=None, splits=200,
+              data_dir=None):
+    stages = stages or list(STAGES)
+    options = {'size': list(size), 'profile': profile, 'workers': workers or cpu_count(), 'splits': splits}
+
+    remove_data = data_dir is None
+    data_dir = data_dir or tempfile.mkdtemp(prefix='opbg_benchmarks_')
+    try:
+        start = time.perf_counter()
+        options['patients'] = generate_dataset(data_dir, patients, size)
+        results = {'generate': {'seconds': time.perf_counter() - start}}
+
+        for name in stages:
+            # Not a multiprocessing.Pool, its processes cannot start the pools of the stages.
+            with ProcessPoolExecutor(1) as executor:
+                results[name] = executor.submit(_run_stage, name, data_dir, options).result()
+            if 'unavailable' in results[name]:
+                print(f"{name}: skipped, {results[name]['unavailable']}", flush=True)
+            else:
+                print(f"{name}: {results[name]['seconds']:.3f}s, {results[name]['peak_rss_mb']:.0f} MB", flush=True)
+    finally:
+        if remove_data:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    return {'environment': {'python': platform.python_version(),
+                            'platform': platform.platform(),
+                            'cpus': cpu_count(),
+                            'numpy': np.__version__,
+                            'SimpleITK': sitk.Version_VersionString()},
+            'options': options,
+            'stages': results}
+
+
+# Compares the seconds of two results of run_suite, returns new / old for
+# every stage in both of them.
+def compare(old_results, new_results):
+    ratios = {}
+    for name, stage in new_results['stages'].items():
+        old_stage = old_results['stages'].get(name, {})
+        if stage.get('seconds') and old_stage.get('seconds'):
+            ratios[name] = stage['seconds'] / old_stage['seconds']
+    return ratios
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the pipeline on synthetic data.')
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), help='stages to run, all by default')
+    parser.add_argument('--size', nargs=3, type=int, default=[128, 128, 64], help='size x y z of the volumes')
+    parser.add_argument('--patients', type=int, default=2)
+    parser.add_argument('--profile', default='fast', help='registration profile')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--splits', type=int, default=200, help='splits of the classification stage')
+    parser.add_argument('--data-dir', help='where the dataset is generated, a temporary directory by default')
+    parser.add_argument('--output', help='json file of the results')
+    parser.add_argument('--compare', help='json file of previous results to compare with')
+    args = parser.parse_args()
+
+    suite_results = run_suite(args.stages, args.size, args.patients, args.profile, args.workers, args.splits,
+                              args.data_dir)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(suite_results, output_file, indent=2)
+    if args.compare:
+        with open(args.compare) as compare_file:
+            for stage_name, ratio in compare(json.load(compare_file), suite_results).items():
+                print(f'{stage_name}: {ratio:.2f}x the time of {args.compare}')
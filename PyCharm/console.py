@@ -0,0 +1,13 @@
+import sys
+
+
+# Prints a progress bar on a single line of the console, as in the radiomics notebooks.
+def progress(count, total, status=''):
+    bar_len = 40
+    filled_len = int(round(bar_len * count / float(total)))
+
+    percents = round(100.0 * count / float(total), 1)
+    bar = '█' * filled_len + '░' * (bar_len - filled_len)
+
+    sys.stdout.write(f'\r|{bar}| {percents}% ... {status}')
+    sys.stdout.flush()
@@ -0,0 +1,24 @@
+from dicom_conversion import DicomConverter
+from dicom_index import DicomIndex
+
+INPUT_DIR = '/Volumes/TOSHIBA EXT/OPBG-DEF/by_type/HEALTHY'
+OUTPUT_DIR = '/Volumes/TOSHIBA EXT/OPBG-DEF/by_type/HEALTHY_NIFTI'
+# The same index of organize.py, only the files changed since its last run are read.
+INDEX_PATH = '/Volumes/TOSHIBA EXT/OPBG-DEF/by_type/HEALTHY_index.sqlite'
+# Writes .nii.gz files when True, .nii files (faster to read and write) otherwise.
+COMPRESS = True
+WORKERS = 4
+
+if __name__ == '__main__':
+    with DicomIndex(INDEX_PATH, INPUT_DIR) as index:
+        index.update()
+        records = index.records()
+
+    # Only the series whose files changed since the last run are converted.
+    converter = DicomConverter(OUTPUT_DIR, compress=COMPRESS, workers=WORKERS)
+    counts = converter.convert(records)
+
+    print(f"Converted {counts['converted']} series, {counts['skipped']} already converted, "
+          f"{counts['failed']} failed")
+    for uid, error in converter.errors:
+        print(f"{uid}: {error}")
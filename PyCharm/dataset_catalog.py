@@ -0,0 +1,236 @@
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from batch_registration import RegistrationPair
+from dicom_index import read_tags
+
+# Tags read from the first file of every series.
+SUMMARY_TAGS = ['Modality', 'ProtocolName', 'SeriesDescription', 'SeriesInstanceUID', 'FrameOfReferenceUID',
+                'ImageOrientationPatient', 'PixelSpacing', 'SliceThickness', 'Rows', 'Columns', 'NumberOfFrames']
+
+# Summary of the header of a series, computed without reading the pixel data.
+# series: path of the series folder relative to the patient folder.
+# slices: number of files, times the frames of multi frame files.
+# spacing: in plane pixel spacing (x, y) in mm, None if unknown.
+# orientation: 'axial', 'coronal' or 'sagittal' from the orientation of the slices.
+SeriesSummary = namedtuple('SeriesSummary',
+                           ['patient', 'series', 'path', 'files', 'slices', 'modality', 'protocol',
+                            'description', 'series_uid', 'frame_of_reference', 'rows', 'columns', 'spacing',
+                            'slice_thickness', 'orientation'])
+
+
+def _to_floats(value):
+    if value is None:
+        return None
+    try:
+        return [float(it) for it in str(value).split('\\')]
+    except ValueError:
+        return None
+
+
+# Returns the orientation of the slices from ImageOrientationPatient, the
+# plane is the one whose normal is closest to the normal of the slices.
+def slice_orientation(image_orientation):
+    orientation = _to_floats(image_orientation)
+    if orientation is None or len(orientation) != 6:
+        return None
+    normal = np.abs(np.cross(orientation[:3], orientation[3:]))
+    return ('sagittal', 'coronal', 'axial')[int(np.argmax(normal))]
+
+
+# Builds the summary of a series from the tags of one of its files.
+def summarize(patient, series, path, files, tags):
+    pixel_spacing = _to_floats(tags.get('PixelSpacing'))
+    slice_thickness = _to_floats(tags.get('SliceThickness'))
+    frames = int(tags.get('NumberOfFrames') or 1)
+
+    return SeriesSummary(patient=patient,
+                         series=series,
+                         path=path,
+                         files=files,
+                         slices=files * frames,
+                         modality=tags.get('Modality'),
+                         protocol=tags.get('ProtocolName'),
+                         description=tags.get('SeriesDescription'),
+                         series_uid=tags.get('SeriesInstanceUID'),
+                         frame_of_reference=tags.get('FrameOfReferenceUID'),
+                         rows=int(tags['Rows']) if tags.get('Rows') else None,
+                         columns=int(tags['Columns']) if tags.get('Columns') else None,
+                         # PixelSpacing is (row spacing, column spacing), i.e. (y, x).
+                         spacing=(pixel_spacing[1], pixel_spacing[0]) if pixel_spacing else None,
+                         slice_thickness=slice_thickness[0] if slice_thickness else None,
+                         orientation=slice_orientation(tags.get('ImageOrientationPatient')))
+
+
+# Rules that choose the reference (fixed) series of a patient from its usable
+# summaries, they return None when no series fits.
+
+# The series with the most slices, as OPBGExplorer and pairs_from_patients do.
+def most_slices(summaries):
+    return max(summaries, key=lambda summary: summary.slices, default=None)
+
+
+# The series with the finest in plane spacing, ties broken by the slices.
+def finest_spacing(summaries):
+    candidates = [summary for summary in summaries if summary.spacing]
+    return min(candidates, key=lambda summary: (max(summary.spacing), -summary.slices), default=None)
+
+
+# Returns a rule that prefers the series whose protocol or description
+# contains one of the given words (e.g. 'T1'), in order, and then applies
+# the fallback rule to the matching series.
+def prefer_protocol(*words, fallback=most_slices):
+    def rule(summaries):
+        for word in words:
+            matching = [summary for summary in summaries if summary_matches(summary, protocol=word)]
+            if matching:
+                return fallback(matching)
+        return fallback(summaries)
+
+    return rule
+
+
+# A series can be registered if it is a volume with a known geometry.
+def is_volume(summary, min_slices=8):
+    return summary.slices >= min_slices and summary.spacing is not None and summary.orientation is not None
+
+
+# Returns True if a summary satisfies all the given criteria.
+# modality: exact modality, e.g. 'MR'.
+# protocol: case insensitive text contained in ProtocolName or SeriesDescription.
+# orientation: 'axial', 'coronal' or 'sagittal'.
+# max_spacing: maximum in plane spacing in mm.
+# min_slices: minimum number of slices.
+# frame_of_reference: exact FrameOfReferenceUID.
+def summary_matches(summary, modality=None, protocol=None, orientation=None, max_spacing=None, min_slices=None,
+                    frame_of_reference=None):
+    if modality is not None and summary.modality != modality:
+        return False
+    if protocol is not None:
+        text = f'{summary.protocol or ""} {summary.description or ""}'.lower()
+        if protocol.lower() not in text:
+            return False
+    if orientation is not None and summary.orientation != orientation:
+        return False
+    if max_spacing is not None and (summary.spacing is None or max(summary.spacing) >= max_spacing):
+        return False
+    if min_slices is not None and summary.slices < min_slices:
+        return False
+    if frame_of_reference is not None and summary.frame_of_reference != frame_of_reference:
+        return False
+    return True
+
+
+# Catalog of a patients tree (root_dir/patient/.../series), the series of a
+# patient are summarized the first time they are requested, reading only a
+# few tags of one file per series, or from a DicomIndex of the tree without
+# reading any file. The summaries are kept for the following queries.
+class DatasetCatalog:
+
+    # Initialization method of the class.
+    # index: optional DicomIndex of root_dir, updated once before its first use.
+    # workers: number of headers read at the same time.
+    def __init__(self, root_dir, index=None, workers=8):
+        self.root_dir = root_dir
+        self.index = index
+        self.workers = workers
+        self._summaries = {}
+        self._index_updated = False
+
+    # Returns the patient folders, nothing is read inside them.
+    def patients(self):
+        return sorted(entry.name for entry in os.scandir(self.root_dir)
+                      if entry.is_dir() and not entry.name.startswith('.'))
+
+    # Returns the series folders of a patient and their files.
+    def series_dirs(self, patient):
+        series = {}
+        patient_dir = os.path.join(self.root_dir, patient)
+        for dir_path, dir_names, file_names in os.walk(patient_dir):
+            dir_names[:] = sorted(name for name in dir_names if not name.startswith('.'))
+            files = sorted(name for name in file_names if not name.startswith('.') and name != 'VERSION')
+            if files:
+                series[os.path.relpath(dir_path, patient_dir)] = [os.path.join(dir_path, name) for name in files]
+        return series
+
+    def _summaries_from_files(self, patient):
+        series = self.series_dirs(patient)
+
+        def summarize_series(name):
+            # The first file that is a dicom file gives the summary.
+            for path in series[name]:
+                try:
+                    tags = read_tags(path, SUMMARY_TAGS)
+                except Exception:
+                    continue
+                return summarize(patient, name, os.path.dirname(path), len(series[name]), tags)
+            return None
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            return [summary for summary in executor.map(summarize_series, sorted(series)) if summary is not None]
+
+    def _summaries_from_index(self, patient):
+        if not self._index_updated:
+            self.index.update()
+            self._index_updated = True
+
+        by_dir = {}
+        for record in self.index.records('patient_dir = ?', (patient,)):
+            by_dir.setdefault(os.path.dirname(record['path']), []).append(record)
+
+        patient_dir = os.path.join(self.root_dir, patient)
+        return [summarize(patient, os.path.relpath(series_dir, patient_dir), series_dir, len(records), records[0])
+                for series_dir, records in sorted(by_dir.items())]
+
+    # Returns the summaries of the series of a patient.
+    def series(self, patient):
+        if patient not in self._summaries:
+            if self.index is not None:
+                self._summaries[patient] = self._summaries_from_index(patient)
+            else:
+                self._summaries[patient] = self._summaries_from_files(patient)
+        return self._summaries[patient]
+
+    # Yields the summaries of all the series that satisfy the criteria of
+    # summary_matches and the optional predicate, patient by patient, e.g. all
+    # the T2 axial series with spacing below 1 mm:
+    # catalog.query(protocol='t2', orientation='axial', max_spacing=1.0)
+    def query(self, predicate=None, patients=None, **criteria):
+        for patient in patients or self.patients():
+            for summary in self.series(patient):
+                if summary_matches(summary, **criteria) and (predicate is None or predicate(summary)):
+                    yield summary
+
+    # Returns the reference series of a patient chosen by the rule among the
+    # usable ones, or None.
+    def reference(self, patient, rule=most_slices, usable=is_volume):
+        return rule([summary for summary in self.series(patient) if usable(summary)])
+
+    # Returns the registration pairs of all the patients: every usable series
+    # is registered on the reference series chosen by the rule.
+    def registration_pairs(self, output_dir, rule=most_slices, usable=is_volume, patients=None):
+        pairs = []
+
+        for patient in patients or self.patients():
+            fixed = self.reference(patient, rule, usable)
+            if fixed is None:
+                continue
+
+            for moving in self.series(patient):
+                if usable(moving):
+                    pairs.append(RegistrationPair(patient,
+                                                  moving.path,
+                                                  fixed.path,
+                                                  os.path.join(output_dir, patient),
+                                                  f"{patient}_coreg_{moving.series.replace(os.sep, '_')}"))
+
+        return pairs
+
+    # Returns the number of files of every series, in the format of
+    # OPBGExplorer.load_patients.
+    def file_counts(self):
+        return {patient: {summary.series: summary.files for summary in self.series(patient)}
+                for patient in self.patients()}
@@ -0,0 +1,242 @@
+import hashlib
+import json
+import os
+import re
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from volume_store import write_nifti
+
+# A series to convert: its uid, the path of the output volume and the
+# records of its files, sorted along the slice direction.
+DicomSeries = namedtuple('DicomSeries', ['uid', 'output_path', 'records'])
+
+# Extension of the sidecar written next to every converted volume.
+SIDECAR_EXTENSION = '.json'
+
+
+# Converts a multiple value to floats, either from pydicom or joined with
+# backslashes by the DicomIndex.
+def _to_floats(value):
+    if isinstance(value, str):
+        value = value.split('\\')
+    return [float(it) for it in value]
+
+
+# Returns a name that can be used as a folder or file name.
+def safe_name(value):
+    return re.sub(r'[^\w.-]+', '_', str(value)).strip('_') or 'unknown'
+
+
+# Sorts the records of a series along the normal of the slices, using the
+# position and orientation of the patient. Falls back to the instance number
+# when the geometry is not in the records.
+def sort_slices(records):
+    try:
+        orientation = np.array(_to_floats(records[0]['ImageOrientationPatient'])).reshape(2, 3)
+        normal = np.cross(orientation[0], orientation[1])
+        distances = [np.dot(normal, _to_floats(record['ImagePositionPatient'])) for record in records]
+    except (KeyError, TypeError, ValueError):
+        return sorted(records, key=lambda record: int(record.get('InstanceNumber') or 0))
+
+    return [records[i] for i in np.argsort(distances, kind='stable')]
+
+
+# Signature of the files of a series, it changes when a file is added,
+# removed or modified.
+def series_signature(records):
+    signature = hashlib.blake2b(digest_size=16)
+    for record in sorted(records, key=lambda record: record['path']):
+        signature.update(f"{record['path']}\t{record['size']}\t{record['mtime_ns']}\n".encode())
+    return signature.hexdigest()
+
+
+# Type of the assembled volume: integer data with an integer rescale stays
+# integer, int16 when the rescaled values fit in it as in most CT and MR series.
+def _volume_dtype(dicom, pixels, slope, intercept):
+    if not (np.issubdtype(pixels.dtype, np.integer) and slope.is_integer() and intercept.is_integer()):
+        return np.float32
+
+    bits_stored = int(getattr(dicom, 'BitsStored', 8 * pixels.dtype.itemsize))
+    signed = int(getattr(dicom, 'PixelRepresentation', 0)) == 1
+    low, high = (-2 ** (bits_stored - 1), 2 ** (bits_stored - 1) - 1) if signed else (0, 2 ** bits_stored - 1)
+    values = sorted((low * slope + intercept, high * slope + intercept))
+    return np.int16 if values[0] >= -2 ** 15 and values[1] < 2 ** 15 else np.int32
+
+
+# Type that holds the values of two volume types: float32 if one of them is
+# float, otherwise the larger integer.
+def _wider_dtype(dtype, other):
+    dtype, other = np.dtype(dtype), np.dtype(other)
+    if np.issubdtype(dtype, np.floating) or np.issubdtype(other, np.floating):
+        return np.dtype(np.float32)
+    return max(dtype, other, key=lambda it: it.itemsize)
+
+
+# Reads the slices of a series in a single preallocated array, one file at a
+# time. Returns the array and the geometry of the slices: origin, spacing and
+# direction as SimpleITK defines them. The type is chosen from the first
+# slice, and widened when a slice has a rescale that doesn't fit in it.
+# records: records of the DicomIndex, sorted with sort_slices.
+def assemble_series(records):
+    import pydicom
+
+    first = pydicom.dcmread(records[0]['path'])
+    rows, columns = int(first.Rows), int(first.Columns)
+
+    volume = None
+    for i, record in enumerate(records):
+        dicom = first if i == 0 else pydicom.dcmread(record['path'])
+        pixels = dicom.pixel_array
+        if pixels.shape != (rows, columns):
+            raise ValueError(f"{record['path']} has size {pixels.shape}, expected {(rows, columns)}")
+
+        slope = float(getattr(dicom, 'RescaleSlope', 1))
+        intercept = float(getattr(dicom, 'RescaleIntercept', 0))
+
+        dtype = _volume_dtype(dicom, pixels, slope, intercept)
+        if volume is None:
+            volume = np.empty((len(records), rows, columns), dtype=dtype)
+        elif _wider_dtype(volume.dtype, dtype) != volume.dtype:
+            # The slices already read are exact in the wider type.
+            volume = volume.astype(_wider_dtype(volume.dtype, dtype))
+        if slope == 1 and intercept == 0:
+            volume[i] = pixels
+        else:
+            np.multiply(pixels, slope, out=volume[i], casting='unsafe')
+            volume[i] += np.asarray(intercept).astype(volume.dtype)
+
+    orientation = _to_floats(first.ImageOrientationPatient)
+    row_direction, column_direction = np.array(orientation[:3]), np.array(orientation[3:])
+    normal = np.cross(row_direction, column_direction)
+    pixel_spacing = _to_floats(first.PixelSpacing)
+
+    if len(records) > 1:
+        positions = np.array([_to_floats(record['ImagePositionPatient']) for record in records])
+        slice_spacing = float(np.mean(np.diff(positions @ normal)))
+    else:
+        slice_spacing = float(getattr(first, 'SliceThickness', 1) or 1)
+
+    # PixelSpacing is (row spacing, column spacing), i.e. (y, x).
+    return volume, (_to_floats(first.ImagePositionPatient),
+                    (pixel_spacing[1], pixel_spacing[0], abs(slice_spacing) or 1.0),
+                    np.column_stack((row_direction, column_direction, normal)).ravel().tolist())
+
+
+# Converts a series in a process of the pool. The sidecar is written after
+# the volume, a volume without it is incomplete and is converted again.
+def _convert_series(series, signature):
+    try:
+        volume, (origin, spacing, direction) = assemble_series(series.records)
+        os.makedirs(os.path.dirname(series.output_path), exist_ok=True)
+        # Written directly from the assembled array, without a SimpleITK copy.
+        write_nifti(volume, series.output_path, origin, spacing, direction)
+
+        with open(sidecar_path(series.output_path), 'w') as sidecar:
+            json.dump({'SeriesInstanceUID': series.uid,
+                       'signature': signature,
+                       'files': [record['path'] for record in series.records]}, sidecar)
+        return series, None
+    except Exception as e:
+        return series, f'{type(e).__name__}: {e}'
+
+
+# Returns the path of the sidecar of a converted volume.
+def sidecar_path(output_path):
+    for extension in ('.nii.gz', '.nii'):
+        if output_path.endswith(extension):
+            return output_path[:-len(extension)] + SIDECAR_EXTENSION
+    return output_path + SIDECAR_EXTENSION
+
+
+# Helper class that converts the dicom series of a DicomIndex to NIfTI
+# volumes in the OUTPUT_DIR/patient/series structure. The slices are grouped
+# by SeriesInstanceUID using the headers of the index, and the series are
+# converted in parallel. A series is converted again only if its files
+# changed, so the conversion can be run after every update of the index and
+# the registration and the radiomics can read the volumes instead of the
+# dicom files.
+class DicomConverter:
+
+    # Initialization method of the class.
+    # compress: writes .nii.gz instead of .nii files.
+    # workers: number of series converted at the same time.
+    # keys: the record values used as folder and file names, the last one is
+    #       the file name.
+    def __init__(self, output_dir, compress=True, workers=4, keys=('PatientName', 'SeriesNumber')):
+        self.output_dir = output_dir
+        self.compress = compress
+        self.workers = workers
+        self.keys = keys
+        self.errors = []
+        # Paths of the volumes of the last conversion, by series uid.
+        self.paths = {}
+
+    # Groups the records by series, returns a list of DicomSeries. When two
+    # series would have the same output path, their uid is added to the name.
+    def series(self, records):
+        by_uid = {}
+        for record in records:
+            if record.get('SeriesInstanceUID'):
+                by_uid.setdefault(record['SeriesInstanceUID'], []).append(record)
+
+        extension = '.nii.gz' if self.compress else '.nii'
+        names = {}
+        for uid, series_records in by_uid.items():
+            folders = [safe_name(series_records[0].get(key)) for key in self.keys]
+            names.setdefault(tuple(folders), []).append(uid)
+
+        series = []
+        for folders, uids in sorted(names.items()):
+            for uid in sorted(uids):
+                file_name = folders[-1] if len(uids) == 1 else f'{folders[-1]}_{safe_name(uid)}'
+                output_path = os.path.join(self.output_dir, *folders[:-1], file_name + extension)
+                series.append(DicomSeries(uid, output_path, sort_slices(by_uid[uid])))
+        return series
+
+    # Returns True if the volume of a series is up to date.
+    @staticmethod
+    def is_converted(series, signature):
+        path = sidecar_path(series.output_path)
+        if not os.path.exists(series.output_path) or not os.path.exists(path):
+            return False
+
+        with open(path) as sidecar:
+            try:
+                return json.load(sidecar).get('signature') == signature
+            except ValueError:
+                return False
+
+    # Converts the series of the given records (e.g. DicomIndex.records()).
+    # Returns a dictionary with the number of converted, already converted and
+    # failed series.
+    def convert(self, records):
+        counts = {'converted': 0, 'skipped': 0, 'failed': 0}
+        paths = {}
+        errors = []
+
+        todo = []
+        for series in self.series(records):
+            signature = series_signature(series.records)
+            if self.is_converted(series, signature):
+                counts['skipped'] += 1
+                paths[series.uid] = series.output_path
+            else:
+                todo.append((series, signature))
+
+        with ProcessPoolExecutor(self.workers) as executor:
+            futures = [executor.submit(_convert_series, series, signature) for series, signature in todo]
+            for future in as_completed(futures):
+                series, error = future.result()
+                if error is None:
+                    counts['converted'] += 1
+                    paths[series.uid] = series.output_path
+                else:
+                    counts['failed'] += 1
+                    errors.append((series.uid, error))
+
+        self.errors = errors
+        self.paths = paths
+        return counts
@@ -0,0 +1,331 @@
+import os
+import queue
+import sqlite3
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import pydicom
+from pydicom.multival import MultiValue
+
+# Tags read from every file when no other list is given.
+DEFAULT_TAGS = ['PatientName', 'PatientID', 'StudyInstanceUID', 'SeriesInstanceUID', 'SeriesNumber',
+                'SOPInstanceUID', 'InstanceNumber', 'Modality', 'ProtocolName', 'SeriesDescription',
+                'FrameOfReferenceUID', 'ImagePositionPatient', 'ImageOrientationPatient',
+                'PixelSpacing', 'SliceThickness', 'Rows', 'Columns']
+
+# Columns describing the file on disk, stored next to the tags.
+FILE_COLUMNS = ['path', 'patient_dir', 'size', 'mtime_ns', 'inode']
+
+# Marks the end of the files of a patient directory in the queue.
+_DONE = object()
+
+# Result of an incremental update: the records of the added and changed
+# files and the paths of the removed ones.
+IndexChanges = namedtuple('IndexChanges', ['added', 'changed', 'removed'])
+
+
+# Converts a pydicom value in something that can be stored in sqlite,
+# multiple values are joined with a backslash as in the dicom files.
+def _to_sql(value):
+    if value is None or isinstance(value, (int, float, str)):
+        return value
+    if isinstance(value, (MultiValue, list, tuple)):
+        return '\\'.join(str(it) for it in value)
+    return str(value)
+
+
+# Reads only the given tags of a dicom file, stopping before the pixel data.
+# Returns a dictionary keyword -> value converted as in the index, None for
+# the missing tags. Raises an exception if the file is not a dicom file.
+def read_tags(path, tags):
+    dicom = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=list(tags))
+    return {tag: _to_sql(dicom.get(tag)) for tag in tags}
+
+
+# Helper class that reads only the headers of the dicom files of a
+# directory tree and stores them in an sqlite index, so that organize,
+# explore and registration can query it instead of reading the files again.
+# The first level of root_dir is considered as the patient directories.
+class DicomIndex:
+
+    # Initialization method of the class.
+    # tags: keywords of the dicom tags that are stored for every file.
+    # workers: number of patient directories scanned at the same time.
+    def __init__(self, index_path, root_dir, tags=None, workers=8, queue_size=10000):
+        self.index_path = index_path
+        self.root_dir = root_dir
+        self.tags = list(tags or DEFAULT_TAGS)
+        self.workers = workers
+        self.queue_size = queue_size
+        self.errors = []
+        # Appended by the reader threads and taken by _write, under the lock.
+        self._skipped = []
+        self._skipped_lock = threading.Lock()
+
+        self.connection = sqlite3.connect(index_path)
+        self.connection.row_factory = sqlite3.Row
+        self._create_table()
+
+    # Creates the table if it doesn't exist and adds the columns
+    # of the tags that were not present in the previous runs.
+    def _create_table(self):
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS files ('
+                                'path TEXT PRIMARY KEY, patient_dir TEXT, size INTEGER, '
+                                'mtime_ns INTEGER, inode INTEGER)')
+
+        columns = {row['name'] for row in self.connection.execute('PRAGMA table_info(files)')}
+        for tag in self.tags:
+            if tag not in columns:
+                self.connection.execute(f'ALTER TABLE files ADD COLUMN "{tag}"')
+
+        self.connection.execute('CREATE INDEX IF NOT EXISTS files_patient_dir ON files (patient_dir)')
+
+        # Files that are not dicom files, kept to avoid reading them again.
+        self.connection.execute('CREATE TABLE IF NOT EXISTS skipped ('
+                                'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER)')
+        # Modification time of the directories at the last scan.
+        self.connection.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER)')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Returns the patient directories of the root directory.
+    def patient_dirs(self):
+        return sorted(entry.path for entry in os.scandir(self.root_dir)
+                      if entry.is_dir() and not entry.name.startswith('.'))
+
+    # Returns the files of a patient directory, hidden ones excluded.
+    @staticmethod
+    def walk_files(patient_dir):
+        for dir_path, dir_names, file_names in os.walk(patient_dir):
+            dir_names[:] = sorted(name for name in dir_names if not name.startswith('.'))
+            for file_name in sorted(file_names):
+                if not file_name.startswith('.') and file_name != 'VERSION':
+                    yield os.path.join(dir_path, file_name)
+
+    # Reads the header of a single file, stopping before the pixel data.
+    # Returns None if the file is not a dicom file.
+    def read_record(self, path, patient_dir):
+        stat = os.stat(path)
+
+        try:
+            tags = read_tags(path, self.tags)
+        except Exception as e:
+            self.errors.append((path, str(e)))
+            with self._skipped_lock:
+                self._skipped.append((path, stat.st_size, stat.st_mtime_ns, stat.st_ino))
+            return None
+
+        record = {'path': path,
+                  'patient_dir': os.path.basename(patient_dir),
+                  'size': stat.st_size,
+                  'mtime_ns': stat.st_mtime_ns,
+                  'inode': stat.st_ino}
+        record.update(tags)
+
+        return record
+
+    # Reads the headers of the given files, each patient directory is read
+    # by a different thread. The records are yielded as soon as they are read
+    # and written in the index in batches.
+    # files_by_patient: dictionary patient directory -> list of files.
+    def _read_records(self, files_by_patient, batch_size=1000):
+        records = queue.Queue(self.queue_size)
+        stop = threading.Event()
+
+        # Waits for a free place in the queue unless the consumer has stopped.
+        def put(item):
+            while not stop.is_set():
+                try:
+                    records.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def scan_patient(patient_dir, paths):
+            try:
+                for path in paths:
+                    if stop.is_set():
+                        return
+                    record = self.read_record(path, patient_dir)
+                    if record is not None:
+                        put(record)
+            finally:
+                put(_DONE)
+
+        batch = []
+        with ThreadPoolExecutor(self.workers) as executor:
+            for patient_dir, paths in files_by_patient.items():
+                executor.submit(scan_patient, patient_dir, paths)
+
+            try:
+                remaining = len(files_by_patient)
+                while remaining:
+                    record = records.get()
+                    if record is _DONE:
+                        remaining -= 1
+                        continue
+
+                    batch.append(record)
+                    if len(batch) >= batch_size:
+                        self._write(batch)
+                        batch = []
+
+                    yield record
+            finally:
+                # Also reached when the consumer stops early: let the threads end
+                # and keep what has been read so far.
+                stop.set()
+                self._write(batch)
+
+    # Writes (or replaces) a list of records in the index, together with
+    # the files that have been skipped until now.
+    def _write(self, records):
+        with self._skipped_lock:
+            skipped, self._skipped = self._skipped, []
+
+        columns = FILE_COLUMNS + self.tags
+        names = ', '.join(f'"{column}"' for column in columns)
+        values = ', '.join('?' for _ in columns)
+        self.connection.executemany(f'INSERT OR REPLACE INTO files ({names}) VALUES ({values})',
+                                    [[record[column] for column in columns] for record in records])
+        self.connection.executemany('INSERT OR REPLACE INTO skipped VALUES (?, ?, ?, ?)', skipped)
+        self.connection.commit()
+
+    # Scans all the patient directories and yields the records while they are
+    # read, so that the caller can start working before the end of the scan.
+    def scan(self):
+        files_by_patient = {patient_dir: self.walk_files(patient_dir) for patient_dir in self.patient_dirs()}
+        yield from self._read_records(files_by_patient)
+
+    # Scans all the patient directories from scratch and returns the number
+    # of indexed files.
+    def build(self):
+        return sum(1 for _ in self.iter_build())
+
+    # Same as build, but the records are yielded while they are read.
+    def iter_build(self):
+        for table in ('files', 'skipped', 'dirs'):
+            self.connection.execute(f'DELETE FROM {table}')
+        self.connection.commit()
+
+        yield from self.scan()
+        self._write_dirs(self._dir_signatures())
+
+    # Returns the modification time of all the directories of the tree.
+    def _dir_signatures(self):
+        signatures = {}
+        for patient_dir in self.patient_dirs():
+            for dir_path, dir_names, _ in os.walk(patient_dir):
+                dir_names[:] = [name for name in dir_names if not name.startswith('.')]
+                signatures[dir_path] = os.stat(dir_path).st_mtime_ns
+        return signatures
+
+    def _write_dirs(self, signatures):
+        self.connection.execute('DELETE FROM dirs')
+        self.connection.executemany('INSERT INTO dirs VALUES (?, ?)', signatures.items())
+        self.connection.commit()
+
+    # Updates the index reading only the files that have been added or changed
+    # since the last scan, and removing the files that don't exist anymore.
+    # A file is changed when its size, modification time or inode are different.
+    # trust_dir_mtime: the files of the directories whose modification time didn't
+    #                  change are not checked one by one. Adding or removing a file
+    #                  changes the directory, overwriting it in place does not.
+    def update(self, trust_dir_mtime=False):
+        changes = IndexChanges([], [], [])
+        for _ in self.iter_update(trust_dir_mtime, changes):
+            pass
+        return changes
+
+    # Same as update, but the records of the added and changed files are yielded
+    # while they are read. The optional changes are filled during the update.
+    def iter_update(self, trust_dir_mtime=False, changes=None):
+        known = {row['path']: (row['size'], row['mtime_ns'], row['inode'])
+                 for table in ('files', 'skipped')
+                 for row in self.connection.execute(f'SELECT path, size, mtime_ns, inode FROM {table}')}
+        known_dirs = {row['path']: row['mtime_ns'] for row in self.connection.execute('SELECT * FROM dirs')}
+
+        signatures = {}
+        seen = set()
+        to_read = {}
+        for patient_dir in self.patient_dirs():
+            for dir_path, dir_names, file_names in os.walk(patient_dir):
+                dir_names[:] = sorted(name for name in dir_names if not name.startswith('.'))
+                signatures[dir_path] = os.stat(dir_path).st_mtime_ns
+                unchanged_dir = trust_dir_mtime and known_dirs.get(dir_path) == signatures[dir_path]
+
+                for file_name in sorted(file_names):
+                    if file_name.startswith('.') or file_name == 'VERSION':
+                        continue
+
+                    path = os.path.join(dir_path, file_name)
+                    seen.add(path)
+                    if unchanged_dir and path in known:
+                        continue
+
+                    stat = os.stat(path)
+                    if known.get(path) != (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+                        to_read.setdefault(patient_dir, []).append(path)
+
+        removed = sorted(path for path in known if path not in seen)
+        if changes is not None:
+            changes.removed.extend(removed)
+
+        # Changed files are removed too, they could have become non dicom files.
+        outdated = removed + [path for paths in to_read.values() for path in paths if path in known]
+        for table in ('files', 'skipped'):
+            self.connection.executemany(f'DELETE FROM {table} WHERE path = ?', ((path,) for path in outdated))
+        self.connection.commit()
+
+        for record in self._read_records(to_read):
+            if changes is not None:
+                (changes.changed if record['path'] in known else changes.added).append(record)
+            yield record
+
+        self._write_dirs(signatures)
+
+    # Returns the records of the index as dictionaries, an optional sqlite
+    # condition can be used to filter them.
+    def records(self, where=None, params=()):
+        query = 'SELECT * FROM files'
+        if where:
+            query += f' WHERE {where}'
+        query += ' ORDER BY path'
+
+        return [dict(row) for row in self.connection.execute(query, params)]
+
+    # Groups the paths of the files as nested dictionaries, e.g. by patient
+    # name and series number as organize.py does.
+    def group_paths(self, keys=('PatientName', 'SeriesNumber'), records=None):
+        groups = {}
+
+        for record in self.records() if records is None else records:
+            group = groups
+            for key in keys[:-1]:
+                group = group.setdefault(record[key], {})
+            group.setdefault(record[keys[-1]], []).append(record['path'])
+
+        return groups
+
+    # Returns the number of files for every patient and series directory,
+    # in the same format returned by OPBGExplorer.load_patients.
+    def count_files(self):
+        counts = {}
+
+        for row in self.connection.execute('SELECT path, patient_dir FROM files'):
+            relative_dir = os.path.relpath(os.path.dirname(row['path']), os.path.join(self.root_dir, row['patient_dir']))
+            sequence = relative_dir.split(os.sep)[0]
+            patient = counts.setdefault(row['patient_dir'], {})
+            patient[sequence] = patient.get(sequence, 0) + 1
+
+        return counts
@@ -1,11 +1,17 @@
+import hashlib
+import json
 import os
-import pydicom as pd
-import nibabel as nib
+from collections import OrderedDict, namedtuple
+
 import numpy as np
-import matplotlib.pyplot as plt
 import SimpleITK as Sitk
 
-from moviepy.editor import *
+from instrumentation import Instrumentation
+from registration_telemetry import IterationCounter, RegistrationTelemetry
+from volume_store import read_image, write_image_nifti, write_nifti
+
+# pydicom, pandas, nibabel, matplotlib and Pillow are imported only by the methods
+# that use them, so that importing this module in the batch workers is fast.
 
 
 # Helper class that maps the folders of the OPBG dataset.
@@ -13,12 +19,19 @@ from moviepy.editor import *
 class OPBGExplorer:
 
     # Initialization method of the class.
-    def __init__(self, root_dir):
+    # index: optional DicomIndex of root_dir, when given only the new or
+    #        changed files are read instead of walking the whole tree.
+    def __init__(self, root_dir, index=None):
         self.root_dir = root_dir
+        self.index = index
 
     # Maps the folders as nested dictionaries that will be
     # used to feed the registration algorithm.
     def load_patients(self):
+        if self.index is not None:
+            self.index.update()
+            return self.index.count_files()
+
         return {
             patient_dir.name: {
                 sequence_dir.name: sum(1 for _ in os.scandir(sequence_dir))
@@ -28,16 +41,160 @@ class OPBGExplorer:
         }
 
 
+# Parameters of the registration performed by RegistrationHelper.get_secondary_transform.
+# shrink_factors, smoothing_sigmas: one value per level of the pyramid, from the
+#                                   coarsest to the finest, sigmas are in mm.
+# optimizer: 'gradient_descent', 'regular_step' or 'lbfgsb'.
+# convergence_minimum_value, convergence_window_size: the gradient descent stops
+#                                                     when the metric stops improving.
+RegistrationProfile = namedtuple('RegistrationProfile',
+                                 ['shrink_factors', 'smoothing_sigmas', 'optimizer', 'learning_rate',
+                                  'iterations', 'convergence_minimum_value', 'convergence_window_size',
+                                  'histogram_bins', 'sampling_percentage'])
+
+# Predefined profiles, see the README for the timings on sample volumes.
+# default: the original single level registration.
+# fast: a single level at a third of the resolution without smoothing, the
+#       smoothing of every level of the pyramid costs more than the iterations.
+# accurate: three levels ending at full resolution with more samples.
+# The regular step optimizer stops by itself when the step becomes too small,
+# the gradient descent when the metric doesn't improve in the convergence window.
+REGISTRATION_PROFILES = {
+    'default': RegistrationProfile(shrink_factors=[1], smoothing_sigmas=[0], optimizer='gradient_descent',
+                                   learning_rate=1.0, iterations=60, convergence_minimum_value=1e-6,
+                                   convergence_window_size=10, histogram_bins=50, sampling_percentage=0.01),
+    'fast': RegistrationProfile(shrink_factors=[3], smoothing_sigmas=[0], optimizer='regular_step',
+                                learning_rate=1.0, iterations=60, convergence_minimum_value=1e-5,
+                                convergence_window_size=5, histogram_bins=32, sampling_percentage=0.02),
+    'accurate': RegistrationProfile(shrink_factors=[4, 2, 1], smoothing_sigmas=[2, 1, 0],
+                                    optimizer='regular_step', learning_rate=1.0, iterations=100,
+                                    convergence_minimum_value=1e-6, convergence_window_size=10,
+                                    histogram_bins=50, sampling_percentage=0.02),
+}
+
+
+# Pixel types used by RegistrationHelper.
+# io: type of the images when they are read, sitkUnknown keeps the type of the files
+#     (usually int16 for dicom), that takes a quarter of the memory of float64.
+# registration: type of the images given to the registration method.
+# output: type of the resampled image, None keeps the type of the moving image.
+PixelTypePolicy = namedtuple('PixelTypePolicy', ['io', 'registration', 'output'])
+
+DEFAULT_PIXEL_TYPES = PixelTypePolicy(io=Sitk.sitkUnknown, registration=Sitk.sitkFloat32, output=None)
+
+# Pixel types of the original pipeline, everything in float64.
+FLOAT64_PIXEL_TYPES = PixelTypePolicy(io=Sitk.sitkFloat64, registration=Sitk.sitkFloat64, output=Sitk.sitkFloat64)
+
+
+# Hashes of the already hashed inputs, keyed by path and modification time,
+# so that the fixed image of a patient is hashed only once per process.
+_content_hashes = {}
+
+
+# Returns the hash of the content of a list of files.
+def content_hash(paths, chunk_size=1024 ** 2):
+    key = tuple((path, os.stat(path).st_mtime_ns) for path in paths)
+    if key in _content_hashes:
+        return _content_hashes[key]
+
+    digest = hashlib.blake2b(digest_size=20)
+    for path in paths:
+        digest.update(os.path.basename(path).encode())
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(chunk_size), b''):
+                digest.update(chunk)
+
+    _content_hashes[key] = digest.hexdigest()
+    return _content_hashes[key]
+
+
+# Helper class that keeps the already decoded volumes in memory, so that
+# the same series is not read again for every registration.
+# The volumes are keyed by path, modification time and pixel type, the
+# least recently used ones are dropped when max_bytes is exceeded.
+class VolumeCache:
+
+    # Initialization method of the class.
+    def __init__(self, max_bytes=2 * 1024 ** 3):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._volumes = OrderedDict()
+
+    # Returns the number of bytes used by the pixels of an image.
+    @staticmethod
+    def image_bytes(image):
+        return image.GetNumberOfPixels() * image.GetNumberOfComponentsPerPixel() * image.GetSizeOfPixelComponent()
+
+    # Returns the key of a series directory (or of a single file).
+    @staticmethod
+    def key(path, pixel_type):
+        return os.path.abspath(path), os.stat(path).st_mtime_ns, pixel_type
+
+    # Returns the cached volume, or loads it with the given function and
+    # stores it in the cache.
+    def get(self, path, pixel_type, loader):
+        key = self.key(path, pixel_type)
+
+        image = self._volumes.get(key)
+        if image is not None:
+            self.hits += 1
+            self._volumes.move_to_end(key)
+            return image
+
+        self.misses += 1
+        image = loader()
+        size = self.image_bytes(image)
+
+        # Volumes bigger than the whole cache are never stored.
+        if size <= self.max_bytes:
+            self._volumes[key] = image
+            self.current_bytes += size
+
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._volumes.popitem(last=False)
+                self.current_bytes -= self.image_bytes(evicted)
+
+        return image
+
+    # Removes all the volumes from the cache.
+    def clear(self):
+        self._volumes.clear()
+        self.current_bytes = 0
+
+    def __len__(self):
+        return len(self._volumes)
+
+
 # Helper class to perform registration on images.
 # author: Riccardo Busetti.
 class RegistrationHelper:
 
     # Initialization method of the class.
-    def __init__(self, moving_image_dir, fixed_image_dir, output_dir, output_file_name):
+    # cache: optional VolumeCache used to read the fixed image, useful when
+    #        many moving images are registered on the same fixed one.
+    # profile: name of one of the REGISTRATION_PROFILES or a RegistrationProfile.
+    # pixel_types: PixelTypePolicy used to read, register and write the images.
+    # record_telemetry: records the optimizer iterations in a RegistrationTelemetry,
+    #                   saved next to the output when the image is saved.
+    # instrumentation: Instrumentation that records the stages, e.g. in a JSONL log,
+    #                  by default the events are only kept in memory.
+    def __init__(self, moving_image_dir, fixed_image_dir, output_dir, output_file_name, cache=None,
+                 profile='default', pixel_types=DEFAULT_PIXEL_TYPES, record_telemetry=False, instrumentation=None):
         self.moving_image_dir = moving_image_dir
         self.fixed_image_dir = fixed_image_dir
         self.output_dir = output_dir
         self.output_name = output_file_name
+        self.cache = cache
+        self.profile = REGISTRATION_PROFILES[profile] if isinstance(profile, str) else profile
+        self.pixel_types = pixel_types
+        self.record_telemetry = record_telemetry
+        self.telemetry = None
+        self.instrumentation = instrumentation or Instrumentation(name=output_file_name)
+        # Filled by start_coregistration with the time spent in each step and
+        # the number and size of the volumes allocated by the resamples.
+        self.report = {}
 
     # Creates the reader object, one for each sequence of
     # dicom images. This readers are then used to perform
@@ -45,22 +202,60 @@ class RegistrationHelper:
     def read_dicom_files(self):
         # Reading meta data of the first sequence of images.
         reader_first = Sitk.ImageSeriesReader()
-        reader_first.SetOutputPixelType(Sitk.sitkFloat64)
+        reader_first.SetOutputPixelType(self.pixel_types.io)
         dicom_first = reader_first.GetGDCMSeriesFileNames(self.moving_image_dir)
         reader_first.SetFileNames(dicom_first)
 
         # Reading meta data of the second sequence of images.
         reader_second = Sitk.ImageSeriesReader()
-        reader_second.SetOutputPixelType(Sitk.sitkFloat64)
+        reader_second.SetOutputPixelType(self.pixel_types.io)
         dicom_second = reader_second.GetGDCMSeriesFileNames(self.fixed_image_dir)
         reader_second.SetFileNames(dicom_second)
 
         return reader_first, reader_second
 
-    # Reads and computes the nifti files.
+    # Reads a sequence of dicom images as a "3D" image, by default
+    # with the io pixel type.
+    def read_dicom_series(self, series_dir, pixel_type=None):
+        reader = Sitk.ImageSeriesReader()
+        reader.SetOutputPixelType(self.pixel_types.io if pixel_type is None else pixel_type)
+        reader.SetFileNames(reader.GetGDCMSeriesFileNames(series_dir))
+        return reader.Execute()
+
+    # Reads the fixed image, passing through the cache if there is one.
+    # The fixed image is only used by the registration, so by default
+    # it is read directly with the registration pixel type.
+    def read_fixed_image(self, is_nifti=False, pixel_type=None):
+        if pixel_type is None:
+            pixel_type = self.pixel_types.registration
+
+        if is_nifti:
+            loader = lambda: read_image(self.fixed_image_dir, pixel_type)
+        else:
+            loader = lambda: self.read_dicom_series(self.fixed_image_dir, pixel_type)
+
+        if self.cache is None:
+            return loader()
+
+        return self.cache.get(self.fixed_image_dir, pixel_type, loader)
+
+    # Reads and computes the nifti files, or any other image file. The volumes
+    # of a VolumeStore are given with the path of their .json sidecar.
     def get_nifti_files(self):
-        return Sitk.ReadImage(self.moving_image_dir), \
-               Sitk.ReadImage(self.fixed_image_dir)
+        return read_image(self.moving_image_dir, self.pixel_types.io), \
+               self.read_fixed_image(is_nifti=True)
+
+    # Casts an image to the registration pixel type, if needed.
+    def to_registration_type(self, image):
+        if image.GetPixelID() == self.pixel_types.registration:
+            return image
+        return Sitk.Cast(image, self.pixel_types.registration)
+
+    # Returns the pixel type of the resampled image.
+    def output_pixel_type(self, moving_image):
+        if self.pixel_types.output is None:
+            return moving_image.GetPixelID()
+        return self.pixel_types.output
 
     # Computes the dicom files from the reader and returns a "3D"
     # image, that will be then resampled.
@@ -73,13 +268,15 @@ class RegistrationHelper:
         # Returns the resampled image.
         return Sitk.Resample(moving_image, fixed_image)
 
-    def final_resample(self, fixed_image, resampled_image, transformation):
+    # Resamples an image on the fixed grid with the given transformation,
+    # by default the pixel type of the image is kept.
+    def final_resample(self, fixed_image, resampled_image, transformation, pixel_type=None):
         return Sitk.Resample(resampled_image,
                              fixed_image,
                              transformation,
                              Sitk.sitkLinear,
                              0.0,
-                             resampled_image.GetPixelIDValue())
+                             resampled_image.GetPixelID() if pixel_type is None else pixel_type)
 
     # Getting the initial transform.
     def get_initial_transform(self, fixed_image, resampled_image):
@@ -89,23 +286,64 @@ class RegistrationHelper:
                                                  Sitk.Euler3DTransform(),
                                                  Sitk.CenteredTransformInitializerFilter.GEOMETRY)
 
+    # Sets the optimizer of the profile on the registration method.
+    def set_optimizer(self, registration_method):
+        profile = self.profile
+
+        if profile.optimizer == 'gradient_descent':
+            registration_method.SetOptimizerAsGradientDescent(learningRate=profile.learning_rate,
+                                                              numberOfIterations=profile.iterations,
+                                                              convergenceMinimumValue=profile.convergence_minimum_value,
+                                                              convergenceWindowSize=profile.convergence_window_size)
+        elif profile.optimizer == 'regular_step':
+            registration_method.SetOptimizerAsRegularStepGradientDescent(learningRate=profile.learning_rate,
+                                                                         minStep=1e-4,
+                                                                         numberOfIterations=profile.iterations,
+                                                                         gradientMagnitudeTolerance=1e-8)
+        elif profile.optimizer == 'lbfgsb':
+            registration_method.SetOptimizerAsLBFGSB(gradientConvergenceTolerance=1e-5,
+                                                     numberOfIterations=profile.iterations)
+        else:
+            raise ValueError(f'Unknown optimizer {profile.optimizer}.')
+
     # Getting the secondary transform.
     def get_secondary_transform(self, fixed_image, resampled_image, initial_transform):
+        profile = self.profile
         registration_method = Sitk.ImageRegistrationMethod()
 
-        registration_method.SetMetricAsMattesMutualInformation(numberOfHistogramBins=50)
+        registration_method.SetMetricAsMattesMutualInformation(numberOfHistogramBins=profile.histogram_bins)
         registration_method.SetMetricSamplingStrategy(registration_method.RANDOM)
-        registration_method.SetMetricSamplingPercentage(0.01)
+        registration_method.SetMetricSamplingPercentage(profile.sampling_percentage)
 
         registration_method.SetInterpolator(Sitk.sitkLinear)
 
-        registration_method.SetOptimizerAsGradientDescent(learningRate=1.0, numberOfIterations=60)
-        registration_method.SetOptimizerScalesFromPhysicalShift()
+        self.set_optimizer(registration_method)
+        # LBFGSB doesn't support the scales.
+        if profile.optimizer != 'lbfgsb':
+            registration_method.SetOptimizerScalesFromPhysicalShift()
+
+        # Multi resolution pyramid, the coarse levels are much faster.
+        registration_method.SetShrinkFactorsPerLevel(shrinkFactors=profile.shrink_factors)
+        registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=profile.smoothing_sigmas)
+        registration_method.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
+
+        if self.record_telemetry:
+            self.telemetry = RegistrationTelemetry().attach(registration_method)
 
         registration_method.SetInitialTransform(initial_transform, inPlace=False)
 
+        iterations = IterationCounter().attach(registration_method)
+
+        transformation = registration_method.Execute(fixed_image, resampled_image)
+        self.instrumentation.event('optimizer',
+                                   optimizer=profile.optimizer,
+                                   iterations=iterations.count,
+                                   levels=len(profile.shrink_factors),
+                                   metric=registration_method.GetMetricValue(),
+                                   stop_condition=registration_method.GetOptimizerStopConditionDescription())
+
         # Returns the coregistration trasformation.
-        return registration_method.Execute(fixed_image, resampled_image)
+        return transformation
 
     # Converts a specified image to numpy array.
     def image_to_nparray(self, image):
@@ -114,6 +352,8 @@ class RegistrationHelper:
 
     # Plot all the images.
     def plot_images(self, *images):
+        import matplotlib.pyplot as plt
+
         # Loop throgh images and plot them.
         for image in images:
             print(str(image.shape))
@@ -122,61 +362,267 @@ class RegistrationHelper:
             plt.show()
         print("--------------------------------------")
 
-    # Converts image as numpy array to nifti and saves it.
-    def nparray_to_nifti(self, image, output_path):
-        nifti_image = nib.Nifti1Image(image, affine=np.eye(4))
-        nib.save(nifti_image, output_path)
+    # Plot the middle axial slice of SimpleITK images, only the slice
+    # is converted to a numpy array.
+    def plot_slices(self, *images):
+        import matplotlib.pyplot as plt
+
+        for image in images:
+            print(str(image.GetSize()[::-1]))
+            plt.imshow(Sitk.GetArrayViewFromImage(image[:, :, image.GetDepth() // 2]))
+            plt.show()
+        print("--------------------------------------")
 
-    # Aligns the current images correctly.
+    # Returns the middle axial slice of an image rescaled to uint8 and
+    # shrunk to at most max_size pixels per side.
+    @staticmethod
+    def qc_slice(image, max_size):
+        image_slice = Sitk.RescaleIntensity(image[:, :, image.GetDepth() // 2], 0, 255)
+        factor = max(1, -(-max(image_slice.GetSize()) // max_size))
+        if factor > 1:
+            image_slice = Sitk.Shrink(image_slice, [factor, factor])
+        return Sitk.Cast(image_slice, Sitk.sitkUInt8)
+
+    # Writes a small png with the middle slice of the fixed image, of the
+    # resampled image and a checkerboard of the two, to check the registration.
+    def write_qc_snapshot(self, fixed_image, resampled_image, max_size=256):
+        fixed_slice = self.qc_slice(fixed_image, max_size)
+        resampled_slice = self.qc_slice(resampled_image, max_size)
+        # The images are on the same grid, the slices only need the same origin.
+        resampled_slice.CopyInformation(fixed_slice)
+        checker_board = Sitk.CheckerBoard(fixed_slice, resampled_slice, [8, 8])
+
+        output_path = os.path.join(self.output_dir, self.output_name + '_qc.png')
+        Sitk.WriteImage(Sitk.Tile([fixed_slice, resampled_slice, checker_board], [3, 1]), output_path)
+        return output_path
+
+    # Converts an image to nifti and saves it. A SimpleITK image is written with
+    # the affine computed from its origin, spacing and direction. A numpy array
+    # is in nibabel order (x, y, z), e.g. the output of align_and_trasnform, and
+    # is written with the geometry of reference_image, or with the identity
+    # affine when it is not given. The data is written slab_slices at a time
+    # for the very large volumes.
+    def nparray_to_nifti(self, image, output_path, reference_image=None, slab_slices=None):
+        if isinstance(image, Sitk.Image):
+            return write_image_nifti(image, output_path, slab_slices)
+        # write_nifti takes the SimpleITK order (z, y, x), the transposed view.
+        if reference_image is None:
+            # Direction that cancels the LPS to RAS flip of nifti_affine.
+            return write_nifti(image.T, output_path, direction=(-1, 0, 0, 0, -1, 0, 0, 0, 1),
+                               slab_slices=slab_slices)
+        return write_nifti(image.T, output_path, reference_image.GetOrigin(), reference_image.GetSpacing(),
+                           reference_image.GetDirection(), slab_slices)
+
+    # Aligns the current images correctly: takes an array in SimpleITK order
+    # (z, y, x) and returns it in nibabel order (x, y, z), flipped left-right.
     def align_and_trasnform(self, image_np):
         image_np = np.swapaxes(image_np, 0, 2)
         return np.fliplr(image_np)
 
+    # Returns the path of an output file of this registration.
+    def output_path(self, file_extension):
+        return os.path.join(self.output_dir, self.output_name + file_extension)
+
+    # Returns the files of an input image, the series files for dicom.
+    @staticmethod
+    def input_files(image_dir, is_nifti):
+        if is_nifti:
+            return [image_dir]
+        return list(Sitk.ImageSeriesReader.GetGDCMSeriesFileNames(image_dir))
+
+    # Returns the key of the registration in the manifest: the hash of the
+    # content of the inputs and of the parameters that change the transform.
+    def manifest_key(self, is_nifti, single_resample):
+        parameters = {'profile': self.profile._asdict(),
+                      'registration_pixel_type': self.pixel_types.registration,
+                      'is_nifti': is_nifti,
+                      'single_resample': single_resample}
+
+        return {'moving': content_hash(self.input_files(self.moving_image_dir, is_nifti)),
+                'fixed': content_hash(self.input_files(self.fixed_image_dir, is_nifti)),
+                'parameters': hashlib.blake2b(json.dumps(parameters, sort_keys=True).encode(),
+                                              digest_size=20).hexdigest()}
+
+    # Returns the manifest of a previous registration, or None.
+    def read_manifest(self):
+        try:
+            with open(self.output_path('_manifest.json')) as manifest_file:
+                return json.load(manifest_file)
+        except (OSError, ValueError):
+            return None
+
+    # Saves the final transform next to the output, with a manifest that
+    # tells from which inputs and parameters it has been computed. Without
+    # key the manifest of a previous run is removed, it doesn't describe the
+    # new transform.
+    def write_transform(self, transformation, key):
+        Sitk.WriteTransform(transformation, self.output_path('.tfm'))
+
+        if key is None:
+            if os.path.exists(self.output_path('_manifest.json')):
+                os.remove(self.output_path('_manifest.json'))
+            return
+
+        manifest = {'key': key,
+                    'transform': os.path.basename(self.output_path('.tfm')),
+                    'moving_image_dir': self.moving_image_dir,
+                    'fixed_image_dir': self.fixed_image_dir}
+        with open(self.output_path('_manifest.json'), 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+
+    # Returns the stored transform if it has been computed from the same inputs
+    # and parameters, otherwise None.
+    def read_valid_transform(self, key):
+        manifest = self.read_manifest()
+        # A manifest without key (e.g. edited by hand) doesn't match any key.
+        if key is None or manifest is None or manifest.get('key') != key:
+            return None
+
+        transform_path = os.path.join(self.output_dir, manifest.get('transform') or '')
+        if not os.path.isfile(transform_path):
+            return None
+
+        return Sitk.ReadTransform(transform_path)
+
     # Writes on disk the resampled image as a specified file.
     def write_resampled_image(self, resampled_image, file_extension):
         # Join the output directory with the file name.
-        output_dir = os.path.join(self.output_dir, self.output_name + file_extension)
+        output_dir = self.output_path(file_extension)
         # Tell the status.
         print("Saving image in " + output_dir)
+        # Images resampled outside of start_coregistration could have another type.
+        if self.pixel_types.output is not None and resampled_image.GetPixelID() != self.pixel_types.output:
+            resampled_image = Sitk.Cast(resampled_image, self.pixel_types.output)
         # Write image on disk as a specified file.
         Sitk.WriteImage(resampled_image, output_dir)
 
+    # Registers the original moving image and writes the result with a single
+    # resample of the composed transform. Returns the resampled image, the
+    # image before the registration (None, it is not computed) and the transform.
+    # The registration works on a copy of the moving image with the registration
+    # pixel type, the resample reads directly the image in its original type.
+    def register_composed(self, moving_image, fixed_image):
+        with self.instrumentation.stage('registration') as timing:
+            registration_image = self.to_registration_type(moving_image)
+            initial_transformation = self.get_initial_transform(fixed_image, registration_image)
+            final_transformation = self.get_secondary_transform(fixed_image, registration_image,
+                                                                initial_transformation)
+            del registration_image
+        self.report['registration_seconds'] = timing['seconds']
+
+        with self.instrumentation.stage('resample') as timing:
+            resampled_image = self.final_resample(fixed_image, moving_image, final_transformation,
+                                                  self.output_pixel_type(moving_image))
+        self.report['resample_seconds'] = timing['seconds']
+        self.report['resampled_volumes'] = 1
+
+        return resampled_image, None, final_transformation
+
+    # Original pipeline: the moving image is resampled on the fixed grid, then
+    # with the initial transform and then with the registration transform.
+    # Returns the same values of register_composed.
+    def register_chained(self, moving_image, fixed_image):
+        output_pixel_type = self.output_pixel_type(moving_image)
+
+        with self.instrumentation.stage('resample', step='initial') as first_timing:
+            resampled_image = self.resample(self.to_registration_type(moving_image), fixed_image)
+
+            # Second resampling process with the centered transformation.
+            initial_transformation = self.get_initial_transform(fixed_image, resampled_image)
+            resampled_image = self.final_resample(fixed_image, resampled_image, initial_transformation)
+            pre_coreg = resampled_image
+
+        with self.instrumentation.stage('registration') as timing:
+            secondary_transformation = self.get_secondary_transform(fixed_image, resampled_image,
+                                                                    initial_transformation)
+        self.report['registration_seconds'] = timing['seconds']
+
+        # Third resampling process with the coregistration transformation.
+        with self.instrumentation.stage('resample', step='final') as timing:
+            resampled_image = self.final_resample(fixed_image, resampled_image, secondary_transformation,
+                                                  output_pixel_type)
+        self.report['resample_seconds'] = first_timing['seconds'] + timing['seconds']
+        self.report['resampled_volumes'] = 3
+
+        # The last transform of the list is applied first to the points, nested
+        # composite transforms are flattened so that they can be written.
+        final_transformation = Sitk.CompositeTransform([initial_transformation, secondary_transformation])
+        final_transformation.FlattenTransform()
+
+        return resampled_image, pre_coreg, final_transformation
+
     # Starts the coregistration.
-    def start_coregistration(self, is_nifti=False, save_on_disk=False, file_extension=".mha"):
+    # single_resample: registers the original moving image and resamples it once
+    #                  with the composed transform, instead of the three chained
+    #                  resamples of the original pipeline that blur the image.
+    # plot: shows the middle slices with matplotlib, disable it on the servers.
+    # qc_snapshot: writes a small png next to the output to check the result.
+    # resume: when the transform saved by a previous run is still valid the pair
+    #         is skipped if the output exists, or the output is written again
+    #         from the saved transform without registering the images.
+    # The final transform is saved when save_on_disk is True, with its manifest
+    # only when resume is True too: the key of the manifest hashes the content
+    # of the inputs, i.e. reads all their files once more.
+    def start_coregistration(self, is_nifti=False, save_on_disk=False, file_extension=".mha",
+                             single_resample=True, plot=True, qc_snapshot=False, resume=False):
         # Variables initialization.
         moving_image = None
         fixed_image = None
+        key = self.manifest_key(is_nifti, single_resample) if resume and save_on_disk else None
 
-        if is_nifti:
-            # Reading and computing nifti files.
-            moving_image, fixed_image = self.get_nifti_files()
-        else:
-            # Reading dicom files.
-            reader_first, reader_second = self.read_dicom_files()
+        stored_transformation = self.read_valid_transform(key) if key is not None else None
+        if stored_transformation is not None and os.path.exists(self.output_path(file_extension)):
+            print("Already registered " + self.output_path(file_extension))
+            self.report['skipped'] = True
+            self.instrumentation.event('skipped', output=self.output_path(file_extension))
+            return None
 
-            # Computing dicom files.
-            moving_image, fixed_image = self.compute_dicom_files(reader_first, reader_second)
+        with self.instrumentation.stage('read', is_nifti=is_nifti) as timing:
+            if is_nifti:
+                # Reading and computing nifti files.
+                moving_image, fixed_image = self.get_nifti_files()
+            else:
+                # Reading dicom files, the fixed one is shared by all the sequences of a patient.
+                moving_image = self.read_dicom_series(self.moving_image_dir)
+                fixed_image = self.read_fixed_image()
+        self.report['read_seconds'] = timing['seconds']
+
+        if stored_transformation is not None:
+            # Only the output is missing, e.g. a new file extension.
+            with self.instrumentation.stage('resample', step='stored') as timing:
+                resampled_image = self.final_resample(fixed_image, moving_image, stored_transformation,
+                                                      self.output_pixel_type(moving_image))
+            self.report['resample_seconds'] = timing['seconds']
+            self.report['resampled_volumes'] = 1
+            pre_coreg = None
+        elif single_resample:
+            resampled_image, pre_coreg, final_transformation = self.register_composed(moving_image, fixed_image)
+        else:
+            resampled_image, pre_coreg, final_transformation = self.register_chained(moving_image, fixed_image)
 
-        # Resampling images.
-        resampled_image = self.resample(moving_image, fixed_image)
+        # Every resample allocates a whole volume on the fixed grid.
+        self.report['resampled_bytes'] = self.report['resampled_volumes'] * VolumeCache.image_bytes(resampled_image)
 
-        # Second resampling process with the centered transformation.
-        initial_transformation = self.get_initial_transform(fixed_image, resampled_image)
-        resampled_image = self.final_resample(fixed_image, resampled_image, initial_transformation)
-        pre_coreg = resampled_image
+        if plot:
+            images = [moving_image, fixed_image, pre_coreg, resampled_image]
+            self.plot_slices(*[image for image in images if image is not None])
 
-        # Third resampling process with the coregistration transformation.
-        secondary_transformation = self.get_secondary_transform(fixed_image, resampled_image, initial_transformation)
-        resampled_image = self.final_resample(fixed_image, resampled_image, secondary_transformation)
-
-        self.plot_images(Sitk.GetArrayFromImage(moving_image),
-                         Sitk.GetArrayFromImage(fixed_image),
-                         Sitk.GetArrayFromImage(pre_coreg),
-                         Sitk.GetArrayFromImage(resampled_image))
+        if qc_snapshot:
+            with self.instrumentation.stage('qc'):
+                self.write_qc_snapshot(fixed_image, resampled_image)
 
         # Write the image in the specified format.
         if save_on_disk:
-            self.write_resampled_image(resampled_image, file_extension)
+            with self.instrumentation.stage('write', file_extension=file_extension):
+                self.write_resampled_image(resampled_image, file_extension)
+                if stored_transformation is None:
+                    self.write_transform(final_transformation, key)
+                if self.telemetry is not None:
+                    self.telemetry.save(self.output_path('_telemetry.npz'),
+                                        name=self.output_name,
+                                        profile=self.profile._asdict())
+
+        return resampled_image
 
 
 # Helper class to help read dicom files.
@@ -185,31 +631,62 @@ class DicomHelper:
 
     # Initialization method of the class.
     def __init__(self):
-        pass
+        # Files that could not be read by the last read_dicom_tags.
+        self.errors = []
 
     # Creates a gif from an array, in our case
     # it will convert a 3D nparray to a gid.
+    # The slices are windowed to uint8 once and shrunk by an integer factor
+    # (scale 0.5 keeps one pixel every 2), scales above 1 are not supported.
+    # Returns the path of the gif.
     def dicom_to_gif(self, output_dir, array, fps=10, scale=1.0):
+        from preview import render_preview
+
         # Ensure that the file has the .gif extension.
         fname, _ = os.path.splitext(output_dir)
         output_dir = fname + '.gif'
 
-        # Copy into the color dimension if the images are black and white.
-        if array.ndim == 3:
-            array = array[..., np.newaxis] * np.ones(3)
-
-        # Make the moviepy clip.
-        clip = ImageSequenceClip(list(array), fps=fps).resize(scale)
-        clip.write_gif(output_dir, fps=fps)
-        return clip
-
-    # Returns a list with the meta data of a dicom file from
-    # a given sequence.
-    def read_dicom_meta_data(self, dicom_dir):
-        dicom_files = list(filter(lambda it: not it.startswith(".") and it != "VERSION", os.listdir(dicom_dir)))
-
-        if len(dicom_files) > 0:
-            return pd.dcmread(os.path.join(dicom_dir, dicom_files[0]))
-        else:
-            return None
-
+        factor = max(1, int(round(1 / scale)))
+        return render_preview(array, output_dir, fps=fps, factor=factor)[0]
+
+    # Returns the meta data of the first dicom file of a given sequence, only
+    # the header is read. tags: keywords of the tags to read, all when None.
+    def read_dicom_meta_data(self, dicom_dir, tags=None):
+        import pydicom
+
+        for entry in sorted(os.scandir(dicom_dir), key=lambda it: it.name):
+            if entry.is_file() and not entry.name.startswith(".") and entry.name != "VERSION":
+                return pydicom.dcmread(entry.path, stop_before_pixels=True, specific_tags=tags)
+
+        return None
+
+    # Reads the given tags of the dicom files of many directories with a pool of
+    # threads, stopping before the pixel data, and returns a table with one row per
+    # file: directory, path and one column per tag (multiple values are joined with
+    # a backslash, as in the DicomIndex). With first_only only the first file of
+    # every directory is read. The files that are not dicom files are skipped and
+    # reported in self.errors.
+    def read_dicom_tags(self, dicom_dirs, tags, first_only=False, workers=16):
+        import pandas as pd
+        from concurrent.futures import ThreadPoolExecutor
+        from dicom_index import read_tags
+
+        paths = []
+        for dicom_dir in dicom_dirs:
+            files = sorted(entry.path for entry in os.scandir(dicom_dir)
+                           if entry.is_file() and not entry.name.startswith(".") and entry.name != "VERSION")
+            paths.extend((dicom_dir, path) for path in (files[:1] if first_only else files))
+
+        def read_row(item):
+            dicom_dir, path = item
+            try:
+                return dict(read_tags(path, tags), directory=dicom_dir, path=path)
+            except Exception as e:
+                self.errors.append((path, str(e)))
+                return None
+
+        self.errors = []
+        with ThreadPoolExecutor(workers) as executor:
+            rows = [row for row in executor.map(read_row, paths) if row is not None]
+
+        return pd.DataFrame(rows, columns=['directory', 'path'] + list(tags))
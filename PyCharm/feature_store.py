@@ -0,0 +1,181 @@
+import os
+import shutil
+
+import numpy as np
+
+from radiomics_extraction import SEQUENCES
+
+# Partition of the numeric columns that don't belong to a sequence (age, survival).
+CLINICAL = 'clinical'
+
+# Files of a partition: values are stored column by column (features, samples),
+# so that a column is contiguous on the disk and a projection reads from the
+# disk only the pages of the selected columns.
+VALUES_NAME = 'values.npy'
+COLUMNS_NAME = 'columns.npy'
+SAMPLES_NAME = 'samples.npy'
+FINITE_NAME = 'finite.npy'
+
+
+# Returns the sequence of a feature column, CLINICAL if it has none.
+def column_sequence(column, sequences=SEQUENCES):
+    for sequence in sequences:
+        if column.endswith(f'_{sequence}'):
+            return sequence
+    return CLINICAL
+
+
+# Helper class that keeps the radiomics features as typed numpy arrays in the
+# STORE_DIR/cohort/sequence structure, instead of the wide csv files written
+# by RadiomicsExtraction. Every partition also stores which columns are finite
+# in all the samples, so the loader doesn't have to check the values again.
+class FeatureStore:
+
+    # Initialization method of the class.
+    def __init__(self, store_dir, sequences=SEQUENCES):
+        self.store_dir = store_dir
+        self.sequences = sequences
+
+    def partition_dir(self, cohort, sequence):
+        return os.path.join(self.store_dir, cohort, sequence)
+
+    # Writes the features of a cohort, table is a pandas DataFrame with a
+    # 'sample' column (e.g. RadiomicsExtraction.load) or the path of a csv.
+    # The cohort is replaced if it already exists.
+    def write(self, table, cohort):
+        import pandas as pd
+
+        if isinstance(table, str):
+            table = pd.read_csv(table)
+
+        table = table.sort_values('sample')
+        samples = table['sample'].to_numpy(dtype=str)
+        numeric = table.drop(columns=['sample']).select_dtypes(include='number')
+
+        partitions = {}
+        for column in numeric.columns:
+            partitions.setdefault(column_sequence(column, self.sequences), []).append(column)
+
+        # Written in a temporary directory and moved, a reader never sees half a cohort.
+        cohort_dir = os.path.join(self.store_dir, cohort)
+        tmp_dir = cohort_dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        for sequence, columns in partitions.items():
+            partition_dir = os.path.join(tmp_dir, sequence)
+            os.makedirs(partition_dir)
+
+            values = np.ascontiguousarray(numeric[columns].to_numpy(dtype=np.float64).T)
+            np.save(os.path.join(partition_dir, VALUES_NAME), values)
+            np.save(os.path.join(partition_dir, COLUMNS_NAME), np.array(columns, dtype=str))
+            np.save(os.path.join(partition_dir, SAMPLES_NAME), samples)
+            np.save(os.path.join(partition_dir, FINITE_NAME), np.isfinite(values).all(axis=1))
+
+        shutil.rmtree(cohort_dir, ignore_errors=True)
+        os.replace(tmp_dir, cohort_dir)
+
+    # Returns the cohorts in the store.
+    def cohorts(self):
+        if not os.path.isdir(self.store_dir):
+            return []
+        return sorted(name for name in os.listdir(self.store_dir)
+                      if os.path.isdir(os.path.join(self.store_dir, name)) and not name.endswith('.tmp'))
+
+    # Returns the partitions (sequences and CLINICAL) of a cohort.
+    def partitions(self, cohort):
+        return sorted(os.listdir(os.path.join(self.store_dir, cohort)))
+
+    # Returns the columns of a partition.
+    def columns(self, cohort, sequence):
+        return np.load(os.path.join(self.partition_dir(cohort, sequence), COLUMNS_NAME)).tolist()
+
+    # Returns the samples of a cohort.
+    def samples(self, cohort):
+        return np.load(os.path.join(self.partition_dir(cohort, self.partitions(cohort)[0]), SAMPLES_NAME)).tolist()
+
+    # Returns the indexes and the names of the selected columns of a partition,
+    # without reading its values.
+    # columns: list of names, or a function that returns True for the columns to keep.
+    # finite_only: keeps only the columns without infinite or missing values.
+    def select_columns(self, cohort, sequence, columns=None, finite_only=False):
+        partition_dir = self.partition_dir(cohort, sequence)
+        names = np.load(os.path.join(partition_dir, COLUMNS_NAME))
+
+        keep = np.ones(len(names), dtype=bool)
+        if finite_only:
+            keep &= np.load(os.path.join(partition_dir, FINITE_NAME))
+        if callable(columns):
+            keep &= np.array([bool(columns(name)) for name in names], dtype=bool)
+        elif columns is not None:
+            keep &= np.isin(names, list(columns))
+
+        selected = np.flatnonzero(keep)
+        return selected, names[selected].tolist()
+
+    # Returns the values, columns and samples of a partition. The values
+    # (columns, samples) are an in memory copy of the selected columns, only
+    # their pages are read from the disk through a memory map.
+    # columns, finite_only: see select_columns.
+    def read_partition(self, cohort, sequence, columns=None, finite_only=False):
+        partition_dir = self.partition_dir(cohort, sequence)
+        selected, names = self.select_columns(cohort, sequence, columns, finite_only)
+
+        values = np.load(os.path.join(partition_dir, VALUES_NAME), mmap_mode='r')
+        return values[selected], names, np.load(os.path.join(partition_dir, SAMPLES_NAME))
+
+    # Loads the features of many cohorts as a contiguous (samples, features)
+    # array, ready for training. A column is kept only if it is in all the
+    # cohorts and, with finite_only, finite in all of them.
+    # Returns the array, the column names, the samples and their cohorts.
+    def load(self, cohorts=None, sequences=None, columns=None, finite_only=True, dtype=np.float32):
+        cohorts = cohorts or self.cohorts()
+        sequences = sequences or self.sequences
+
+        # Columns kept in every cohort, in the order of the first one.
+        selected = None
+        for cohort in cohorts:
+            names = set()
+            for sequence in sequences:
+                if sequence in self.partitions(cohort):
+                    names.update(self.select_columns(cohort, sequence, columns, finite_only)[1])
+            selected = names if selected is None else selected & names
+
+        blocks, samples, sample_cohorts, names = [], [], [], []
+        for cohort in cohorts:
+            parts = []
+            cohort_names = []
+            for sequence in sequences:
+                if sequence not in self.partitions(cohort):
+                    continue
+                values, part_names, part_samples = self.read_partition(cohort, sequence,
+                                                                       lambda name: name in selected)
+                parts.append(values)
+                cohort_names.extend(part_names)
+            if not parts:
+                continue
+
+            block = np.concatenate(parts, axis=0)
+            if not names:
+                names = cohort_names
+            elif cohort_names != names:
+                # Same columns in another order: take the rows in the order of the first cohort.
+                position = {name: i for i, name in enumerate(cohort_names)}
+                block = block[[position[name] for name in names]]
+
+            blocks.append(block.T)
+            samples.extend(part_samples.tolist())
+            sample_cohorts.extend([cohort] * len(part_samples))
+
+        x = np.empty((len(samples), len(names)), dtype=dtype)
+        start = 0
+        for block in blocks:
+            x[start:start + len(block)] = block
+            start += len(block)
+        return x, names, samples, sample_cohorts
+
+    # Loads two cohorts as the features and the binary labels (1 for the
+    # positive cohort) used by mcc_evaluation.MCCEvaluation.
+    def training_arrays(self, positive, negative, sequences=None, columns=None, dtype=np.float32):
+        x, names, samples, sample_cohorts = self.load([positive, negative], sequences, columns, dtype=dtype)
+        labels = (np.array(sample_cohorts) == positive).astype(np.int8)
+        return x, labels, names
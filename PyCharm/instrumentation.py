@@ -0,0 +1,143 @@
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+
+# Returns the peak resident memory of the process in MB.
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+# Reads the events of a JSONL log, skipping a line cut by an interrupted run.
+# run: keeps only the events of a run, e.g. BatchRegistration.run_id, the log
+#      is appended by all the runs.
+def read_events(log_path, run=None):
+    events = []
+    with open(log_path) as log_file:
+        for line in log_file:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if run is None or event.get('run') == run:
+                events.append(event)
+    return events
+
+
+# Sums the seconds of the stage events by patient and by stage, and counts the
+# pairs, the errors and the optimizer iterations. The 'batch' entry contains
+# the totals of all the patients of the events, e.g. of a run with read_events.
+def summarize(events):
+    summary = {}
+
+    for event in events:
+        patients = ['batch'] + ([event['patient']] if event.get('patient') else [])
+        for patient in patients:
+            entry = summary.setdefault(patient, {'stages': {}, 'pairs': 0, 'errors': 0, 'iterations': 0,
+                                                 'peak_rss_mb': 0.0})
+            if event['event'] == 'stage':
+                entry['stages'][event['name']] = entry['stages'].get(event['name'], 0.0) + event['seconds']
+                entry['peak_rss_mb'] = max(entry['peak_rss_mb'], event['peak_rss_mb'])
+            elif event['event'] == 'pair':
+                entry['pairs'] += 1
+                entry['errors'] += event.get('error') is not None
+            elif event['event'] == 'optimizer':
+                entry['iterations'] += event['iterations']
+
+    return summary
+
+
+# Prints the summary of summarize, one line per patient and the batch at the end.
+def print_summary(summary):
+    for patient in sorted(summary, key=lambda name: (name == 'batch', name)):
+        entry = summary[patient]
+        stages = ', '.join(f'{name} {seconds:.1f}s' for name, seconds in
+                           sorted(entry['stages'].items(), key=lambda item: -item[1]))
+        print(f"{patient}: {entry['pairs']} pairs, {entry['errors']} errors, {entry['iterations']} iterations, "
+              f"peak {entry['peak_rss_mb']:.0f} MB | {stages}")
+
+
+# Records the time, the cpu time and the memory high-water mark of the stages
+# of the pipeline, and any other event (e.g. the optimizer iterations), as one
+# json object per line in log_path. The context (e.g. patient and pair) is added
+# to every event. Without log_path the events are only kept in self.events.
+# With profile_dir the blocks run with profile() are also profiled by cProfile.
+class Instrumentation:
+
+    # Initialization method of the class.
+    def __init__(self, log_path=None, profile_dir=None, **context):
+        self.log_path = log_path
+        self.profile_dir = profile_dir
+        self.context = context
+        self.events = []
+
+    # Records an event with the given fields.
+    def event(self, event, **fields):
+        record = dict(self.context, event=event, time=time.time(), pid=os.getpid(), **fields)
+        self.events.append(record)
+
+        if self.log_path is not None:
+            # A single write of a line, the workers can append to the same log.
+            with open(self.log_path, 'a') as log_file:
+                log_file.write(json.dumps(record, default=str) + '\n')
+        return record
+
+    # Times the block of a stage. The returned dictionary receives the seconds
+    # when the block ends, so the caller can use them. The stage is recorded
+    # even if the block raises an exception.
+    @contextmanager
+    def stage(self, name, **fields):
+        timing = {}
+        peak_before = peak_rss_mb()
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        error = None
+        try:
+            yield timing
+        except BaseException as e:
+            error = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            timing['seconds'] = time.perf_counter() - start
+            timing['cpu_seconds'] = time.process_time() - cpu_start
+            peak = peak_rss_mb()
+            self.event('stage', name=name, error=error, seconds=timing['seconds'],
+                       cpu_seconds=timing['cpu_seconds'], peak_rss_mb=peak,
+                       peak_growth_mb=peak - peak_before, **fields)
+
+    # Decorator that records every call of a function as a stage.
+    def timed(self, name=None):
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(name or function.__name__):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    # Profiles the block with cProfile when profile_dir is set, the statistics
+    # are written in profile_dir/name_pid.prof (snakeviz, pstats). Without it,
+    # the block only runs: to sample a run with py-spy, attach it to the pid
+    # written in the events.
+    @contextmanager
+    def profile(self, name):
+        if self.profile_dir is None:
+            yield
+            return
+
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            os.makedirs(self.profile_dir, exist_ok=True)
+            profiler.dump_stats(os.path.join(self.profile_dir, f'{name}_{os.getpid()}.prof'))
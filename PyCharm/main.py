@@ -1,44 +1,59 @@
-from operator import itemgetter
-import traceback
+import os
 
-from dicom_utilities import *
+from batch_registration import BatchRegistration
+from dataset_catalog import DatasetCatalog, most_slices
+from instrumentation import print_summary, read_events, summarize
 
 PATIENTS_DIR = '/Users/riccardobusetti/Desktop/MB_PROC'
-
-
-def do_registration(data):
-    for patient in data:
-        seqs = data[patient].items()
-
-        fixed, _ = max(seqs, key=itemgetter(1))
-
-        out_study_dir = os.path.join('/Users/riccardobusetti/Desktop/MB_COREG', patient)
-
-        print(out_study_dir)
-
-        if not os.path.exists(out_study_dir):
-            os.makedirs(out_study_dir)
-
-        for moving, _ in set(seqs):
-            try:
-                RegistrationHelper(
-                    os.path.join(PATIENTS_DIR, patient, moving),
-                    os.path.join(PATIENTS_DIR, patient, fixed),
-                    out_study_dir,
-                    f'{patient}_coreg_{moving}'
-                ).start_coregistration(is_nifti=False,
-                                       save_on_disk=True,
-                                       file_extension=".nii")
-            except RuntimeError as e:
-                print(e)
-                traceback.print_exc()
-            print("Finished patient")
-
-        print("\n----------\n")
-
-
-helper = OPBGExplorer(PATIENTS_DIR)
-do_registration(helper.load_patients())
+OUTPUT_DIR = '/Users/riccardobusetti/Desktop/MB_COREG'
+
+# Number of processes used for the registration, None uses all the cores.
+WORKERS = None
+# Chooses the fixed series of every patient, see dataset_catalog for the other
+# rules, e.g. prefer_protocol('T1') or finest_spacing.
+REFERENCE_RULE = most_slices
+# Timings of every stage of every pair, appended by the workers.
+LOG_PATH = os.path.join(OUTPUT_DIR, 'registration_log.jsonl')
+# Folder of the cProfile statistics of every pair, None disables the profiling.
+PROFILE_DIR = None
+
+
+def print_result(result):
+    if result.error is None:
+        print(f"Finished {result.pair.output_name} in {round(result.elapsed, 2)}s")
+    else:
+        print(f"Failed {result.pair.output_name}")
+        print(result.error)
+
+
+# The patient schedule registers all the sequences of a patient in the same
+# worker, so that the fixed image is read only once.
+def do_registration(pairs, workers=WORKERS, schedule=BatchRegistration.SCHEDULE_PATIENT):
+    batch = BatchRegistration(workers=workers,
+                              schedule=schedule,
+                              is_nifti=False,
+                              save_on_disk=True,
+                              qc_snapshot=True,
+                              resume=True,
+                              file_extension=".nii",
+                              log_path=LOG_PATH,
+                              profile_dir=PROFILE_DIR)
+
+    os.makedirs(os.path.dirname(LOG_PATH), exist_ok=True)
+    results = batch.run(pairs, on_result=print_result)
+
+    print("\n----------\n")
+    batch.print_report(results)
+    # The log also contains the previous runs, only this one is summarized.
+    print_summary(summarize(read_events(LOG_PATH, run=batch.run_id)))
+
+    return results
+
+
+if __name__ == '__main__':
+    # Only the headers are read, the series that are not volumes are skipped.
+    catalog = DatasetCatalog(PATIENTS_DIR)
+    do_registration(catalog.registration_pairs(OUTPUT_DIR, rule=REFERENCE_RULE))
 
 '''helper = RegistrationHelper("/Volumes/LaCie/out/OPBG2001/5",
                             "/Volumes/LaCie/out/OPBG2001/6",
@@ -0,0 +1,159 @@
+import time
+from multiprocessing import Pool, cpu_count, shared_memory
+
+import numpy as np
+
+from console import progress
+
+# Columns of the RadiomicsExtraction output that are not features.
+NON_FEATURE_COLUMNS = ('sample', 'age', 'surv', 'tumor')
+
+# Data of the worker process, set by _init_worker. The features are a view on
+# the shared memory, so they are never copied to the workers.
+_worker = {}
+
+
+# Default classifier of the HGG vs LGG experiments.
+def linear_svc(C=0.001):
+    from sklearn.svm import LinearSVC
+
+    return LinearSVC(C=C)
+
+
+# Reads the features of the two classes written by RadiomicsExtraction and
+# returns a contiguous float32 array of the features (samples, features), the
+# labels (1 for the first csv, 0 for the second one) and the feature names.
+# The features with infinite or missing values in any sample are dropped.
+def load_features(positive_csv, negative_csv):
+    import pandas as pd
+
+    tables = [pd.read_csv(positive_csv), pd.read_csv(negative_csv)]
+    labels = np.concatenate([np.ones(len(tables[0]), dtype=np.int8), np.zeros(len(tables[1]), dtype=np.int8)])
+
+    data = pd.concat(tables, ignore_index=True)
+    data = data.drop(columns=[name for name in NON_FEATURE_COLUMNS if name in data.columns])
+    data = data.select_dtypes(include='number')
+
+    x = data.to_numpy(dtype=np.float32)
+    valid = np.isfinite(x).all(axis=0)
+    return np.ascontiguousarray(x[:, valid]), labels, list(data.columns[valid])
+
+
+# Returns the train and test indices of every split, (n_splits, n_train) and
+# (n_splits, n_test), drawn from a seeded generator so that the experiments
+# can be repeated.
+def split_indices(n_samples, n_splits=2000, test_size=0.2, seed=0):
+    n_test = int(np.ceil(test_size * n_samples))
+    rng = np.random.default_rng(seed)
+    permutations = np.argsort(rng.random((n_splits, n_samples)), axis=1)
+    return permutations[:, n_test:], permutations[:, :n_test]
+
+
+# Matthews correlation coefficient of many binary predictions at once,
+# y_true and y_pred are (n_splits, n_test) arrays of 0 and 1. Returns 0 when
+# the coefficient is not defined, as sklearn does.
+def matthews_corrcoef(y_true, y_pred):
+    y_true = np.asarray(y_true, dtype=bool)
+    y_pred = np.asarray(y_pred, dtype=bool)
+
+    tp = np.sum(y_true & y_pred, axis=-1, dtype=np.float64)
+    tn = np.sum(~y_true & ~y_pred, axis=-1, dtype=np.float64)
+    fp = np.sum(~y_true & y_pred, axis=-1, dtype=np.float64)
+    fn = np.sum(y_true & ~y_pred, axis=-1, dtype=np.float64)
+
+    denominator = np.sqrt((tp + fp) * (tp + fn) * (tn + fp) * (tn + fn))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(denominator > 0, (tp * tn - fp * fn) / denominator, 0.0)
+
+
+def _init_worker(shm_name, shape, dtype, labels, train, test, classifier, classifier_options):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker.update(shm=shm,
+                   x=np.ndarray(shape, dtype=dtype, buffer=shm.buf),
+                   labels=labels, train=train, test=test,
+                   classifier=classifier, classifier_options=classifier_options)
+
+
+# Runs a chunk of splits in the worker, returns the first split and the MCC
+# of every split of the chunk.
+def _run_splits(chunk):
+    start, stop = chunk
+    x, labels = _worker['x'], _worker['labels']
+
+    predictions = np.empty((stop - start, _worker['test'].shape[1]), dtype=np.int8)
+    for row, split in enumerate(range(start, stop)):
+        train, test = _worker['train'][split], _worker['test'][split]
+        x_train, x_test = x[train], x[test]
+
+        # Standardization with the statistics of the training set only.
+        mean = x_train.mean(axis=0)
+        std = x_train.std(axis=0)
+        std[std == 0] = 1
+        x_train -= mean
+        x_train /= std
+        x_test -= mean
+        x_test /= std
+
+        classifier = _worker['classifier'](**_worker['classifier_options'])
+        classifier.fit(x_train, labels[train])
+        predictions[row] = classifier.predict(x_test)
+
+    return start, matthews_corrcoef(labels[_worker['test'][start:stop]], predictions)
+
+
+# Helper class that evaluates a classifier with many random train/test splits
+# (Monte Carlo cross validation) in parallel. The features are copied once in
+# a shared memory block read by all the workers, the splits are drawn before
+# the run and every worker returns the MCC of a chunk of splits.
+class MCCEvaluation:
+
+    # Initialization method of the class.
+    # x, labels: features (samples, features) and binary labels, e.g. from load_features.
+    # classifier: picklable function that returns a new sklearn classifier.
+    # classifier_options: arguments of the classifier function.
+    # workers: number of processes, defaults to the number of cores.
+    # chunk_size: number of splits of each task, defaults to 4 tasks per worker.
+    def __init__(self, x, labels, classifier=linear_svc, classifier_options=None, n_splits=2000, test_size=0.2,
+                 workers=None, seed=0, chunk_size=None):
+        self.x = np.ascontiguousarray(x, dtype=np.float32)
+        self.labels = np.asarray(labels, dtype=np.int8)
+        self.classifier = classifier
+        self.classifier_options = classifier_options or {}
+        self.n_splits = n_splits
+        self.test_size = test_size
+        self.workers = workers or cpu_count()
+        self.seed = seed
+        self.chunk_size = chunk_size or max(1, n_splits // (4 * self.workers))
+        self.seconds = None
+
+    # Returns the MCC of every split, in the order of the splits.
+    def run(self):
+        train, test = split_indices(len(self.labels), self.n_splits, self.test_size, self.seed)
+        chunks = [(start, min(start + self.chunk_size, self.n_splits))
+                  for start in range(0, self.n_splits, self.chunk_size)]
+        mccs = np.empty(self.n_splits)
+
+        t0 = time.time()
+        shm = shared_memory.SharedMemory(create=True, size=self.x.nbytes)
+        try:
+            np.ndarray(self.x.shape, dtype=self.x.dtype, buffer=shm.buf)[:] = self.x
+
+            initargs = (shm.name, self.x.shape, self.x.dtype, self.labels, train, test,
+                        self.classifier, self.classifier_options)
+            with Pool(self.workers, initializer=_init_worker, initargs=initargs) as pool:
+                done = 0
+                for start, chunk_mccs in pool.imap_unordered(_run_splits, chunks):
+                    mccs[start:start + len(chunk_mccs)] = chunk_mccs
+                    done += len(chunk_mccs)
+                    progress(done, self.n_splits)
+        finally:
+            shm.close()
+            shm.unlink()
+
+        self.seconds = time.time() - t0
+        print(f' ... {round(self.seconds, 2)}s, {round(self.splits_per_second(), 1)} splits/s')
+        return mccs
+
+    # Throughput of the last run.
+    def splits_per_second(self):
+        return self.n_splits / self.seconds if self.seconds else 0.0
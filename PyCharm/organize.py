@@ -1,28 +1,35 @@
-import os
-import shutil
-from collections import defaultdict
-
-import pydicom
+from dicom_index import DicomIndex
+from organizer import DatasetOrganizer
 
 INPUT_DIR = '/Volumes/TOSHIBA EXT/OPBG-DEF/by_type/HEALTHY'
 OUTPUT_DIR = '/Volumes/TOSHIBA EXT/OPBG-DEF/by_type/HEALTHY_PROC'
+# The index is kept outside of the input directory, it is reused by
+# the explore and registration steps.
+INDEX_PATH = '/Volumes/TOSHIBA EXT/OPBG-DEF/by_type/HEALTHY_index.sqlite'
+# When True only the files added or changed since the last run are read and placed.
+INCREMENTAL = True
+# How the files are placed in OUTPUT_DIR: 'hardlink', 'reflink', 'symlink' or 'copy'.
+STRATEGY = 'hardlink'
+
+organizer = DatasetOrganizer(OUTPUT_DIR, strategy=STRATEGY)
+
 
-folders = defaultdict(lambda: defaultdict(list))
+# The added and changed files while they are read, then all the files of the
+# index, queried after the update: the files indexed by an interrupted run but
+# never placed are placed, and the files that were removed are not in it.
+def updated_records(index):
+    yield from index.iter_update()
+    yield from index.records()
 
-for patient_dir in os.scandir(INPUT_DIR):
-    if not patient_dir.name.startswith('.'):
-        for dicom_file in os.scandir(patient_dir):
-            if not dicom_file.name.startswith('.')\
-                    and not dicom_file.is_dir():
-                dicom = pydicom.dcmread(dicom_file.path)
 
-                folders[dicom.PatientName][dicom.SeriesNumber].append(dicom_file.path)
-print("Finished mapping!")
+with DicomIndex(INDEX_PATH, INPUT_DIR) as index:
+    # Only the headers are read, the pixel data is never loaded, and each
+    # file is placed as soon as its header has been read. Both passes give
+    # all the files of the dataset, the removed ones are removed from OUTPUT_DIR.
+    records = updated_records(index) if INCREMENTAL else index.iter_build()
+    counts = organizer.organize(records, prune=True)
 
-for patient in folders:
-    for series in folders[patient]:
-        folder_path = os.path.join(OUTPUT_DIR, str(patient), str(series))
-        os.makedirs(folder_path, exist_ok=True)
-        print(f"Folder {folder_path} just created, insertion in progress...")
-        for image in folders[patient][series]:
-            shutil.copy(image, folder_path)
+print(f"Placed {counts['placed']} files ({counts['fallback']} copied), "
+      f"{counts['skipped']} already placed, {counts['removed']} removed, {counts['failed']} failed")
+for path, error in organizer.errors:
+    print(f"{path}: {error}")
@@ -0,0 +1,224 @@
+import os
+import shutil
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Linux ioctl used to clone a file sharing its blocks (btrfs, xfs).
+_FICLONE = 0x40049409
+
+
+# Creates dst as a copy-on-write clone of src, the data is not duplicated
+# until one of the two files is modified. Raises OSError if the file
+# system doesn't support it.
+def reflink(src, dst):
+    if sys.platform.startswith('linux'):
+        import fcntl
+
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            fcntl.ioctl(dst_file.fileno(), _FICLONE, src_file.fileno())
+    elif sys.platform == 'darwin':
+        # APFS clones are created with cp -c.
+        if subprocess.run(['cp', '-c', src, dst]).returncode != 0:
+            raise OSError(f'Cannot clone {src}')
+    else:
+        raise OSError(f'Reflinks are not supported on {sys.platform}')
+
+
+# Helper class that places the dicom files in the OUTPUT_DIR/patient/series
+# structure, while their headers are read by the DicomIndex.
+# The placements are done by a pool of threads and every placed file is
+# written in a journal with the signature (size, modification time and inode)
+# of its source, so that an interrupted run starts where it stopped and a
+# source that changed since it was placed is placed again.
+class DatasetOrganizer:
+
+    HARDLINK = 'hardlink'
+    REFLINK = 'reflink'
+    SYMLINK = 'symlink'
+    COPY = 'copy'
+
+    JOURNAL_NAME = '.organize_journal'
+
+    # Initialization method of the class.
+    # strategy: 'hardlink' and 'reflink' don't use more space, 'symlink' points
+    #           to the original files, 'copy' duplicates them.
+    # workers: number of files placed at the same time.
+    # max_pending: maximum number of files waiting to be placed.
+    # keys: the record values used as folder names.
+    # fallback_to_copy: copies the file when the link cannot be created, e.g.
+    #                   hardlinks between different drives.
+    def __init__(self, output_dir, strategy=COPY, workers=8, max_pending=256,
+                 keys=('PatientName', 'SeriesNumber'), fallback_to_copy=True):
+        self.placers = {self.HARDLINK: os.link,
+                        self.REFLINK: reflink,
+                        self.SYMLINK: lambda src, dst: os.symlink(os.path.abspath(src), dst),
+                        self.COPY: shutil.copy}
+        if strategy not in self.placers:
+            raise ValueError(f'Unknown strategy {strategy}, use one of {", ".join(self.placers)}.')
+
+        self.output_dir = output_dir
+        self.strategy = strategy
+        self.workers = workers
+        self.max_pending = max_pending
+        self.keys = keys
+        self.fallback_to_copy = fallback_to_copy
+        self.journal_path = os.path.join(output_dir, self.JOURNAL_NAME)
+        self.errors = []
+
+    # Returns the path where the file of a record is placed.
+    def destination(self, record):
+        folders = [str(record[key]) for key in self.keys]
+        return os.path.join(self.output_dir, *folders, os.path.basename(record['path']))
+
+    # Reads the journal of the previous runs, returns a dictionary placed source
+    # file -> (destination, signature of the source when it was placed). The
+    # last line of a source wins, a removed source has no destination. The
+    # signature is None in the journals written before it was recorded.
+    def read_journal(self):
+        placed = {}
+        if not os.path.exists(self.journal_path):
+            return placed
+
+        with open(self.journal_path) as journal:
+            for line in journal:
+                # The last line can be cut by an interrupted run.
+                if not line.endswith('\n'):
+                    continue
+
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) > 1 and fields[1]:
+                    signature = tuple(int(it) for it in fields[2:5]) if len(fields) == 5 else None
+                    placed[fields[0]] = (fields[1], signature)
+                else:
+                    placed.pop(fields[0], None)
+        return placed
+
+    # Returns the signature of the source file of a record, from the index
+    # when the record has it.
+    @staticmethod
+    def signature(record):
+        if all(key in record for key in ('size', 'mtime_ns', 'inode')):
+            return record['size'], record['mtime_ns'], record['inode']
+        stat = os.stat(record['path'])
+        return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    # Removes a placed file.
+    @staticmethod
+    def remove(dst):
+        if os.path.lexists(dst):
+            os.remove(dst)
+
+    # Removes the given folders, and their parents, when they are empty. Must
+    # not run while files are placed, a placement creates its folder first.
+    def remove_empty_folders(self, folders):
+        output_dir = os.path.abspath(self.output_dir)
+        # The deepest folders first, their parents can become empty.
+        for folder in sorted(set(folders), key=lambda it: it.count(os.sep), reverse=True):
+            while os.path.abspath(folder) != output_dir:
+                try:
+                    os.rmdir(folder)
+                except OSError:
+                    break
+                folder = os.path.dirname(folder)
+
+    # Places a single file, returns True if it has been copied instead of linked.
+    def place(self, src, dst):
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+
+        # Left by an interrupted run before it was written in the journal.
+        if os.path.lexists(dst):
+            os.remove(dst)
+
+        try:
+            self.placers[self.strategy](src, dst)
+            return False
+        except OSError:
+            if not self.fallback_to_copy or self.strategy == self.COPY:
+                raise
+            if os.path.lexists(dst):
+                os.remove(dst)
+            shutil.copy(src, dst)
+            return True
+
+    # Places the files of the given records (e.g. DicomIndex.scan), each file
+    # is placed as soon as its record arrives. The same file can be given more
+    # than once, it is placed and counted only the first time. A file already
+    # placed is placed again if it changed or if its destination changed (e.g.
+    # a new PatientName), the previous destination is removed.
+    # prune: the records are the whole dataset, the files placed by the previous
+    #        runs that are not in the records anymore are removed from the output.
+    # Returns a dictionary with the number of placed, already placed, copied as
+    # fallback, removed and failed files.
+    def organize(self, records, prune=False):
+        done = self.read_journal()
+        submitted = set()
+        counts = {'placed': 0, 'skipped': 0, 'fallback': 0, 'removed': 0, 'failed': 0}
+        errors = []
+        # Folders of the removed files, removed at the end if they are empty.
+        emptied = set()
+
+        lock = threading.Lock()
+        slots = threading.BoundedSemaphore(self.max_pending)
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(self.journal_path, 'a') as journal:
+
+            def place(src, dst, signature, previous):
+                try:
+                    fallback = self.place(src, dst)
+                    if previous is not None and previous != dst:
+                        self.remove(previous)
+                    with lock:
+                        if previous is not None and previous != dst:
+                            emptied.add(os.path.dirname(previous))
+                        journal.write('\t'.join([src, dst, *map(str, signature)]) + '\n')
+                        journal.flush()
+                        counts['placed'] += 1
+                        counts['fallback'] += fallback
+                except Exception as e:
+                    with lock:
+                        counts['failed'] += 1
+                        errors.append((src, str(e)))
+                finally:
+                    slots.release()
+
+            with ThreadPoolExecutor(self.workers) as executor:
+                for record in records:
+                    src = record['path']
+                    # Given again, e.g. by the second pass of organize.py, it isn't counted twice.
+                    if src in submitted:
+                        continue
+                    submitted.add(src)
+
+                    dst = self.destination(record)
+                    signature = self.signature(record)
+                    previous = done.get(src)
+                    if previous == (dst, signature) and os.path.lexists(dst):
+                        counts['skipped'] += 1
+                        continue
+
+                    # Blocks the reading of the headers when too many files are waiting.
+                    slots.acquire()
+                    executor.submit(place, src, dst, signature, previous[0] if previous else None)
+
+            # All the placements are finished.
+            if prune:
+                for src in sorted(set(done) - submitted):
+                    try:
+                        self.remove(done[src][0])
+                        with lock:
+                            emptied.add(os.path.dirname(done[src][0]))
+                            journal.write(f'{src}\t\n')
+                            journal.flush()
+                            counts['removed'] += 1
+                    except OSError as e:
+                        with lock:
+                            counts['failed'] += 1
+                            errors.append((src, str(e)))
+
+        self.remove_empty_folders(emptied)
+
+        self.errors = errors
+        return counts
@@ -0,0 +1,166 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import SimpleITK as Sitk
+
+from volume_store import IMAGE_EXTENSIONS, read_image, strip_image_extension
+
+# Formats written by write_animation, chosen with the extension of the file.
+ANIMATION_EXTENSIONS = ('.gif', '.webp')
+
+# Files written next to the volumes by the pipeline, a folder with only these
+# files is not a dicom series.
+NON_DICOM_EXTENSIONS = ('.json', '.raw', '.tfm', '.npz', '.png', '.csv', '.txt') + ANIMATION_EXTENSIONS
+
+
+# Maps a volume to uint8 in a single pass, with the intensities between low and
+# high stretched to 0-255. When the window is not given it goes from the 1st to
+# the 99th percentile, computed on a strided sample of the voxels. The slices
+# are converted a slab at a time, so no float copy of the whole volume is made.
+def window_to_uint8(array, window=None, percentiles=(1, 99), slab_slices=16):
+    if window is None:
+        sample = array[:, ::4, ::4]
+        window = np.percentile(sample, percentiles)
+    low, high = float(window[0]), float(window[1])
+    scale = 255.0 / (high - low) if high > low else 0.0
+
+    output = np.empty(array.shape, dtype=np.uint8)
+    for start in range(0, len(array), slab_slices):
+        slab = array[start:start + slab_slices].astype(np.float32)
+        slab -= low
+        slab *= scale
+        np.clip(slab, 0, 255, out=slab)
+        output[start:start + slab_slices] = slab
+    return output
+
+
+# Shrinks the slices (the last two axes) by an integer factor, keeping one
+# pixel every factor or averaging blocks of factor x factor pixels.
+def downsample(frames, factor, method='stride'):
+    if factor <= 1:
+        return frames
+    if method == 'stride':
+        return frames[:, ::factor, ::factor]
+    if method == 'mean':
+        depth, height, width = frames.shape
+        height, width = height // factor * factor, width // factor * factor
+        blocks = frames[:, :height, :width].reshape(depth, height // factor, factor, width // factor, factor)
+        return blocks.mean(axis=(2, 4), dtype=np.float32).astype(np.uint8)
+    raise ValueError(f'Unknown method {method}, use stride or mean.')
+
+
+# Returns the smallest integer factor that fits the slices in max_size pixels.
+def fit_factor(shape, max_size):
+    return max(1, -(-max(shape[-2:]) // max_size)) if max_size else 1
+
+
+# Writes uint8 frames (frames, height, width) as an animated grayscale gif or
+# webp. The gif uses the grayscale palette of the frames, without any
+# quantization.
+def write_animation(frames, output_path, fps=10):
+    from PIL import Image
+
+    if not output_path.endswith(ANIMATION_EXTENSIONS):
+        raise ValueError(f'Unknown format of {output_path}, use one of {", ".join(ANIMATION_EXTENSIONS)}.')
+
+    images = [Image.fromarray(np.ascontiguousarray(frame)) for frame in frames]
+    images[0].save(output_path, save_all=True, append_images=images[1:], duration=int(1000 / fps), loop=0)
+    return output_path
+
+
+# Writes the middle slice of uint8 frames as a png thumbnail.
+def write_thumbnail(frames, output_path):
+    from PIL import Image
+
+    Image.fromarray(np.ascontiguousarray(frames[len(frames) // 2])).save(output_path)
+    return output_path
+
+
+# Renders the axial slices of an image (SimpleITK image or numpy array in
+# SimpleITK order) as an animation of at most max_size pixels per side, and
+# optionally its middle slice as a png thumbnail. Returns the written paths.
+# factor: shrink factor of the slices, computed from max_size when not given.
+def render_preview(image, output_path, fps=10, max_size=256, window=None, method='stride', thumbnail_path=None,
+                   factor=None):
+    array = Sitk.GetArrayViewFromImage(image) if isinstance(image, Sitk.Image) else image
+
+    # Striding before the windowing converts only the pixels that are kept.
+    factor = factor or fit_factor(array.shape, max_size)
+    if method == 'stride':
+        frames = window_to_uint8(downsample(array, factor, method), window)
+    else:
+        frames = downsample(window_to_uint8(array, window), factor, method)
+
+    paths = [write_animation(frames, output_path, fps)]
+    if thumbnail_path is not None:
+        paths.append(write_thumbnail(frames, thumbnail_path))
+    return paths
+
+
+# Returns the series of a tree: the image files and the folders with dicom
+# files, as paths relative to root_dir.
+def find_series(root_dir):
+    series = []
+    for dir_path, dir_names, file_names in os.walk(root_dir):
+        dir_names[:] = sorted(name for name in dir_names if not name.startswith('.'))
+        file_names = sorted(name for name in file_names if not name.startswith('.') and name != 'VERSION')
+
+        images = [name for name in file_names if name.endswith(IMAGE_EXTENSIONS)]
+        series.extend(os.path.relpath(os.path.join(dir_path, name), root_dir) for name in images)
+        others = [name for name in file_names if not name.endswith(IMAGE_EXTENSIONS + NON_DICOM_EXTENSIONS)]
+        if others and Sitk.ImageSeriesReader.GetGDCMSeriesFileNames(dir_path):
+            series.append(os.path.relpath(dir_path, root_dir))
+    return series
+
+
+# Reads a series, a dicom folder or an image file.
+def read_series(path):
+    if os.path.isdir(path):
+        reader = Sitk.ImageSeriesReader()
+        reader.SetFileNames(reader.GetGDCMSeriesFileNames(path))
+        return reader.Execute()
+    return read_image(path)
+
+
+def _render_series(input_path, output_path, thumbnail_path, options):
+    try:
+        render_preview(read_series(input_path), output_path, thumbnail_path=thumbnail_path, **options)
+        return input_path, None
+    except Exception as e:
+        return input_path, f'{type(e).__name__}: {e}'
+
+
+# Renders the previews of all the series of a patients tree in parallel, in
+# output_dir with the same structure. A series is rendered again only when it
+# is newer than its preview. Returns the number of rendered, already rendered
+# and failed series, the errors are in the returned list.
+# options: fps, max_size, window and method of render_preview.
+def render_tree(root_dir, output_dir, workers=4, extension='.gif', thumbnails=True, **options):
+    counts = {'rendered': 0, 'skipped': 0, 'failed': 0}
+    errors = []
+
+    jobs = []
+    for relative_path in find_series(root_dir):
+        input_path = os.path.join(root_dir, relative_path)
+        output_path = os.path.join(output_dir, strip_image_extension(relative_path)) + extension
+        thumbnail_path = output_path[:-len(extension)] + '.png' if thumbnails else None
+
+        if os.path.exists(output_path) and os.path.getmtime(output_path) >= os.path.getmtime(input_path):
+            counts['skipped'] += 1
+            continue
+
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        jobs.append((input_path, output_path, thumbnail_path))
+
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(_render_series, *job, options) for job in jobs]
+        for future in as_completed(futures):
+            input_path, error = future.result()
+            if error is None:
+                counts['rendered'] += 1
+            else:
+                counts['failed'] += 1
+                errors.append((input_path, error))
+
+    return counts, errors
@@ -0,0 +1,16 @@
+from preview import render_tree
+
+PATIENTS_DIR = '/Volumes/TOSHIBA EXT/OPBG-DEF/by_type/HEALTHY_PROC'
+OUTPUT_DIR = '/Volumes/TOSHIBA EXT/OPBG-DEF/by_type/HEALTHY_GIFS'
+WORKERS = 4
+# '.gif' or '.webp', a png thumbnail of the middle slice is written next to every animation.
+EXTENSION = '.gif'
+# Maximum size in pixels of the side of the frames.
+MAX_SIZE = 256
+
+if __name__ == '__main__':
+    counts, errors = render_tree(PATIENTS_DIR, OUTPUT_DIR, workers=WORKERS, extension=EXTENSION, max_size=MAX_SIZE)
+
+    print(f"Rendered {counts['rendered']} series, {counts['skipped']} already rendered, {counts['failed']} failed")
+    for path, error in errors:
+        print(f"{path}: {error}")
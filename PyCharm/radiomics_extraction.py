@@ -0,0 +1,290 @@
+import csv
+import math
+import os
+import time
+import traceback
+from collections import OrderedDict, namedtuple
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+import SimpleITK as sitk
+
+from console import progress
+from volume_store import read_image
+
+# Sequences of the BraTS dataset, could change with OPBG.
+SEQUENCES = ('t1', 't1ce', 't2', 'flair')
+
+# A subject to extract: sample name, dictionary sequence -> image path,
+# label path and extra values copied in the row (e.g. age and survival).
+ExtractionTask = namedtuple('ExtractionTask', ['sample', 'images', 'label', 'extra'])
+
+# Extractor of the worker process, created once by _init_worker.
+_extractor = None
+# True when the worker crops all the sequences to the mask once (see _shared_crop).
+_crop_once = True
+
+
+# Creates the pyradiomics extractor, the class has been renamed in the
+# recent versions of pyradiomics.
+def create_extractor(params=None):
+    from radiomics import featureextractor
+
+    extractor_class = getattr(featureextractor, 'RadiomicsFeatureExtractor', None) or \
+        getattr(featureextractor, 'RadiomicsFeaturesExtractor')
+    return extractor_class(params) if params else extractor_class()
+
+
+def _init_worker(params, crop_once=True):
+    global _extractor, _crop_once
+    _extractor = create_extractor(params)
+    _crop_once = crop_once
+
+
+# Converts the values returned by pyradiomics (numpy scalars and 0-d arrays).
+def _to_value(value):
+    if isinstance(value, np.ndarray) and value.size == 1:
+        return value.item()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+# Returns the region (index, size) of the label around the segmentation, padded
+# so that the filters and the resampling of pyradiomics have the same voxels
+# around the mask they would have on the whole image. None if the region can't
+# be shared by the sequences (empty mask or normalization on the whole image).
+def _shared_crop(label, settings):
+    if settings.get('normalize', False):
+        return None
+
+    shape_filter = sitk.LabelShapeStatisticsImageFilter()
+    shape_filter.Execute(sitk.Cast(label == settings.get('label', 1), sitk.sitkUInt8))
+    if not shape_filter.HasLabel(1):
+        return None
+
+    bounding_box = shape_filter.GetBoundingBox(1)
+    dimension = label.GetDimension()
+    pad_distance = settings.get('padDistance', 5)
+    resampled_spacing = settings.get('resampledPixelSpacing') or label.GetSpacing()
+
+    index, size = [], []
+    for axis in range(dimension):
+        # pyradiomics pads after the resampling, in voxels of the new spacing.
+        spacing = label.GetSpacing()[axis]
+        pad = math.ceil(pad_distance * max(1.0, resampled_spacing[axis] / spacing if resampled_spacing[axis] else 1.0)) + 1
+        start = max(bounding_box[axis] - pad, 0)
+        end = min(bounding_box[axis] + bounding_box[axis + dimension] + pad, label.GetSize()[axis])
+        index.append(start)
+        size.append(end - start)
+    return index, size
+
+
+# Returns True if the image is on the same grid of the label.
+def _same_grid(image, label, tolerance=1e-3):
+    return image.GetSize() == label.GetSize() and \
+        np.allclose(image.GetOrigin(), label.GetOrigin(), atol=tolerance) and \
+        np.allclose(image.GetSpacing(), label.GetSpacing(), atol=tolerance) and \
+        np.allclose(image.GetDirection(), label.GetDirection(), atol=tolerance)
+
+
+# Extracts the features of all the sequences of a subject in the worker.
+# The label is read and validated once, and when the sequences are co-registered
+# with it they are all cropped to the same region around the mask before
+# pyradiomics filters them. Returns the task, the row, the seconds spent in
+# every stage and the error (None when everything went fine).
+def _extract(task):
+    timing = {'sample': task.sample}
+    try:
+        t0 = time.perf_counter()
+        full_label = read_image(task.label)
+        timing['read_label'] = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        label = full_label
+        region = _shared_crop(full_label, _extractor.settings) if _crop_once else None
+        if region is not None:
+            label = sitk.RegionOfInterest(full_label, region[1], region[0])
+        timing['crop_label'] = time.perf_counter() - t0
+
+        row = {}
+        for seq, image_path in task.images.items():
+            t0 = time.perf_counter()
+            image = read_image(image_path)
+            timing[f'read_{seq}'] = time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            seq_label = full_label
+            # A sequence not co-registered with the label is left to pyradiomics.
+            if region is not None and _same_grid(image, full_label):
+                image = sitk.RegionOfInterest(image, region[1], region[0])
+                seq_label = label
+            timing[f'crop_{seq}'] = time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            result = _extractor.execute(image, seq_label)
+            timing[f'extract_{seq}'] = time.perf_counter() - t0
+
+            for key, value in result.items():
+                if not key.startswith('general_'):
+                    row[f'{key}_{seq}'] = _to_value(value)
+
+        row.update(task.extra)
+        row['sample'] = task.sample
+        return task, row, timing, None
+    except Exception:
+        return task, None, timing, traceback.format_exc()
+
+
+# Builds the tasks of a BraTS like directory: one folder per sample with the
+# files {sample}_{seq}.nii.gz and {sample}_seg.nii.gz. When a survival csv is
+# given, age and survival are added to the rows (None if not available).
+def brats_tasks(data_dir, samples=None, sequences=SEQUENCES, survival_csv=None, prefix='Brats18'):
+    if samples is None:
+        samples = sorted(filter(lambda x: x.startswith(prefix), os.listdir(data_dir)))
+
+    survival = {}
+    if survival_csv is not None:
+        with open(survival_csv) as survival_file:
+            survival = {row['BraTS18ID']: row for row in csv.DictReader(survival_file)}
+
+    def to_int(value):
+        try:
+            return int(float(value))
+        except (TypeError, ValueError):
+            return None
+
+    tasks = []
+    for sample in samples:
+        row = survival.get(sample, {})
+        tasks.append(ExtractionTask(sample,
+                                    {seq: os.path.join(data_dir, sample, f'{sample}_{seq}.nii.gz') for seq in sequences},
+                                    os.path.join(data_dir, sample, f'{sample}_seg.nii.gz'),
+                                    {'age': to_int(row.get('Age')), 'surv': to_int(row.get('Survival'))}))
+    return tasks
+
+
+# Helper class that extracts the radiomics features of many subjects in
+# parallel. Every worker returns its rows directly, the tasks are given to
+# the first free worker, and the rows are written to the output while they
+# arrive, so that an interrupted run can be resumed.
+class RadiomicsExtraction:
+
+    # Initialization method of the class.
+    # params: path of the pyradiomics parameters file.
+    # output_path: a .csv file, or a directory of .parquet parts.
+    # workers: number of processes, defaults to the number of cores.
+    # checkpoint_every: number of rows of each parquet part.
+    # crop_once: crops all the sequences of a subject to the mask once, instead
+    #            of letting pyradiomics filter and crop the whole image of every
+    #            sequence.
+    def __init__(self, output_path, params=None, workers=None, checkpoint_every=50, crop_once=True):
+        self.output_path = output_path
+        self.params = params
+        self.workers = workers or cpu_count()
+        self.checkpoint_every = checkpoint_every
+        self.crop_once = crop_once
+        self.is_parquet = not output_path.endswith('.csv')
+        self.errors = []
+        # Seconds spent in every stage, one dictionary per subject.
+        self.timings = []
+
+    # Returns the samples already written by a previous run.
+    def completed_samples(self):
+        import pandas as pd
+
+        if not os.path.exists(self.output_path):
+            return set()
+        if self.is_parquet:
+            parts = self._parquet_parts()
+            if not parts:
+                return set()
+            return set(pd.concat([pd.read_parquet(part, columns=['sample']) for part in parts])['sample'])
+        return set(pd.read_csv(self.output_path, usecols=['sample'])['sample'])
+
+    def _csv_header(self):
+        with open(self.output_path, newline='') as csv_file:
+            return next(csv.reader(csv_file))
+
+    def _parquet_parts(self):
+        return sorted(os.path.join(self.output_path, name) for name in os.listdir(self.output_path)
+                      if name.endswith('.parquet'))
+
+    # Writes a list of rows as a new parquet part.
+    def _write_part(self, rows):
+        import pandas as pd
+
+        os.makedirs(self.output_path, exist_ok=True)
+        part = os.path.join(self.output_path, f'part-{len(self._parquet_parts()):05d}.parquet')
+        pd.DataFrame.from_records(rows).to_parquet(part)
+
+    # Extracts the features of the tasks that are not in the output yet.
+    # Returns the table with all the rows of the output.
+    def run(self, tasks, chunksize=1):
+        completed = self.completed_samples()
+        tasks = [task for task in tasks if task.sample not in completed]
+
+        t0 = time.time()
+        csv_file = None
+        writer = None
+        pending = []
+
+        try:
+            with Pool(self.workers, initializer=_init_worker, initargs=(self.params, self.crop_once)) as pool:
+                for count, (task, row, timing, error) in enumerate(pool.imap_unordered(_extract, tasks, chunksize), 1):
+                    progress(count, len(tasks), status=f'Extracting Features ... {task.sample}')
+                    self.timings.append(timing)
+
+                    if error is not None:
+                        self.errors.append((task.sample, error))
+                        continue
+
+                    if self.is_parquet:
+                        pending.append(row)
+                        if len(pending) >= self.checkpoint_every:
+                            self._write_part(pending)
+                            pending = []
+                        continue
+
+                    # The columns of the csv are the ones of the first row.
+                    if writer is None:
+                        write_header = not os.path.exists(self.output_path)
+                        csv_file = open(self.output_path, 'a', newline='')
+                        fieldnames = list(row) if write_header else self._csv_header()
+                        writer = csv.DictWriter(csv_file, fieldnames=fieldnames, extrasaction='ignore')
+                        if write_header:
+                            writer.writeheader()
+                    writer.writerow(row)
+                    csv_file.flush()
+        finally:
+            if pending:
+                self._write_part(pending)
+            if csv_file is not None:
+                csv_file.close()
+
+        print(f' ... {round(time.time() - t0, 2)}s')
+        return self.load()
+
+    # Returns the mean seconds per subject of every stage (reading, cropping and
+    # extraction of every sequence) and of the whole subject.
+    def timing_summary(self):
+        stages = OrderedDict()
+        for timing in self.timings:
+            for stage, seconds in timing.items():
+                if stage != 'sample':
+                    stages.setdefault(stage, []).append(seconds)
+
+        summary = OrderedDict((stage, float(np.mean(seconds))) for stage, seconds in stages.items())
+        summary['total'] = float(np.mean([sum(seconds for stage, seconds in timing.items() if stage != 'sample')
+                                          for timing in self.timings])) if self.timings else 0.0
+        return summary
+
+    # Reads the whole output as a table.
+    def load(self):
+        import pandas as pd
+
+        if not os.path.exists(self.output_path) or (self.is_parquet and not self._parquet_parts()):
+            return pd.DataFrame()
+        if self.is_parquet:
+            return pd.concat([pd.read_parquet(part) for part in self._parquet_parts()], ignore_index=True)
+        return pd.read_csv(self.output_path)
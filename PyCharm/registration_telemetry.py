@@ -0,0 +1,213 @@
+import json
+import time
+
+import numpy as np
+import SimpleITK as sitk
+
+
+class IterationCounter(object):
+    """
+    Counts the optimizer iterations of a SimpleITK ImageRegistrationMethod over
+    all the levels of the pyramid. Some optimizers (e.g. LBFGSB) report an
+    iteration event for every function evaluation, an iteration is counted only
+    when GetOptimizerIteration changes.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._last_iteration = None
+
+    def attach(self, registration_method):
+        """
+        Adds the commands that count the iterations to a registration method.
+
+        Args:
+            registration_method (SimpleITK.ImageRegistrationMethod): the registration.
+        """
+        registration_method.AddCommand(sitk.sitkStartEvent, self.reset)
+        registration_method.AddCommand(sitk.sitkMultiResolutionIterationEvent, self.next_level)
+        registration_method.AddCommand(sitk.sitkIterationEvent, lambda: self.update(registration_method))
+        return self
+
+    def reset(self):
+        self.count = 0
+        self._last_iteration = None
+
+    def next_level(self):
+        self._last_iteration = None
+
+    def update(self, registration_method):
+        """
+        Called at every iteration event.
+
+        Returns:
+            int: the optimizer iteration, or None if it was already counted.
+        """
+        iteration = registration_method.GetOptimizerIteration()
+        if iteration == self._last_iteration:
+            return None
+        self._last_iteration = iteration
+        self.count += 1
+        return iteration
+
+
+class RegistrationTelemetry(object):
+    """
+    Records the optimizer iterations of a SimpleITK ImageRegistrationMethod in
+    preallocated arrays, without plotting during the registration. Unlike the
+    metric_* callbacks of registration_utilities the state belongs to the
+    object, so it can be used by many registrations in parallel workers.
+    The data is written to a compact .npz file and can be plotted after the run.
+    """
+
+    def __init__(self, capacity=256):
+        """
+        Args:
+            capacity (int): number of iterations preallocated, the arrays double
+                            their size when they are full.
+        """
+        self.capacity = capacity
+        self.size = 0
+        self.levels = 0
+        self.start_time = None
+        self.end_time = None
+        self.stop_condition = ''
+        self._iterations = IterationCounter()
+        self._metric = np.empty(capacity)
+        self._time = np.empty(capacity)
+        self._level = np.empty(capacity, dtype=np.int16)
+        self._iteration = np.empty(capacity, dtype=np.int32)
+        self._position = None
+
+    def attach(self, registration_method):
+        """
+        Adds the commands that record the data to a registration method.
+
+        Args:
+            registration_method (SimpleITK.ImageRegistrationMethod): the registration.
+        """
+        registration_method.AddCommand(sitk.sitkStartEvent, self._start)
+        registration_method.AddCommand(sitk.sitkMultiResolutionIterationEvent, self._next_level)
+        registration_method.AddCommand(sitk.sitkIterationEvent, lambda: self._record(registration_method))
+        registration_method.AddCommand(sitk.sitkEndEvent, lambda: self._end(registration_method))
+        return self
+
+    def _start(self):
+        self.size = 0
+        self.levels = 0
+        self._iterations.reset()
+        self.start_time = time.perf_counter()
+
+    def _next_level(self):
+        self.levels += 1
+        self._iterations.next_level()
+
+    def _end(self, registration_method):
+        self.end_time = time.perf_counter()
+        self.stop_condition = registration_method.GetOptimizerStopConditionDescription()
+
+    def _grow(self):
+        self.capacity *= 2
+        for name in ('_metric', '_time', '_level', '_iteration', '_position'):
+            old = getattr(self, name)
+            new = np.empty((self.capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def _record(self, registration_method):
+        # Only complete iterations are recorded, not the function evaluations.
+        iteration = self._iterations.update(registration_method)
+        if iteration is None:
+            return
+
+        position = registration_method.GetOptimizerPosition()
+        if self._position is None or self._position.shape[1] != len(position):
+            self._position = np.empty((self.capacity, len(position)))
+        if self.size == self.capacity:
+            self._grow()
+
+        index = self.size
+        self._metric[index] = registration_method.GetMetricValue()
+        self._time[index] = time.perf_counter() - self.start_time
+        # The first level starts before the first MultiResolutionIterationEvent.
+        self._level[index] = max(self.levels - 1, 0)
+        self._iteration[index] = iteration
+        self._position[index] = position
+        self.size += 1
+
+    def arrays(self):
+        """
+        Returns:
+            dict: metric value, seconds since the start, pyramid level, optimizer
+                  iteration and optimizer position (one row per iteration).
+        """
+        arrays = {'metric': self._metric[:self.size],
+                  'time': self._time[:self.size],
+                  'level': self._level[:self.size],
+                  'iteration': self._iteration[:self.size]}
+        arrays['position'] = self._position[:self.size] if self._position is not None else np.empty((0, 0))
+        return arrays
+
+    def save(self, file_name, **metadata):
+        """
+        Writes the recorded data and the given metadata to a .npz file.
+
+        Args:
+            file_name (str): output file name.
+            metadata: values stored as json next to the arrays (e.g. patient).
+        """
+        metadata = dict(metadata,
+                        stop_condition=self.stop_condition,
+                        seconds=(self.end_time - self.start_time) if self.end_time else None)
+        np.savez_compressed(file_name, metadata=np.array(json.dumps(metadata)), **self.arrays())
+
+    @staticmethod
+    def load(file_name):
+        """
+        Returns:
+            (arrays, metadata) (dict, dict): the data written by save.
+        """
+        with np.load(file_name) as data:
+            arrays = {name: data[name] for name in data.files if name != 'metadata'}
+            metadata = json.loads(str(data['metadata']))
+        return arrays, metadata
+
+    @staticmethod
+    def summarize(file_names):
+        """
+        Summary of many telemetry files, one row for each registration, to
+        compare the convergence across a whole batch.
+
+        Returns:
+            list(dict): file, iterations, levels, seconds, first and last metric value.
+        """
+        rows = []
+        for file_name in file_names:
+            arrays, metadata = RegistrationTelemetry.load(file_name)
+            metric = arrays['metric']
+            rows.append(dict(metadata,
+                             file=file_name,
+                             iterations=len(metric),
+                             levels=int(arrays['level'].max()) + 1 if len(metric) else 0,
+                             first_metric=float(metric[0]) if len(metric) else None,
+                             last_metric=float(metric[-1]) if len(metric) else None))
+        return rows
+
+    @staticmethod
+    def plot(file_name):
+        """
+        Plots the metric value of a saved registration, the stars mark the
+        start of the pyramid levels.
+        """
+        import matplotlib.pyplot as plt
+
+        arrays, metadata = RegistrationTelemetry.load(file_name)
+        metric, level = arrays['metric'], arrays['level']
+        level_starts = np.flatnonzero(np.diff(level, prepend=-1))
+
+        plt.plot(metric, 'r')
+        plt.plot(level_starts, metric[level_starts], 'b*')
+        plt.xlabel('Iteration Number', fontsize=12)
+        plt.ylabel('Metric Value', fontsize=12)
+        plt.title(metadata.get('stop_condition', ''), fontsize=8)
+        plt.show()
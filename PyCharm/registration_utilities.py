@@ -66,8 +66,8 @@ def absolute_orientation_m(points_in_left, points_in_right):
     # Center both data sets on the mean.
     left_mean = left_mat.mean(1)
     right_mean = right_mat.mean(1)
-    left_M = left_mat - np.tile(left_mean, (num_points, 1)).T     
-    right_M = right_mat - np.tile(right_mean, (num_points, 1)).T     
+    left_M = left_mat - left_mean[:, np.newaxis]
+    right_M = right_mat - right_mean[:, np.newaxis]
     
     M = left_M.dot(right_M.T)               
     U,S,Vt = linalg.svd(M)
@@ -79,6 +79,117 @@ def absolute_orientation_m(points_in_left, points_in_right):
     return R,t
 
 
+def absolute_orientation_batch(points_in_left, points_in_right, weights=None, with_scale=False):
+    """
+    Batched version of absolute_orientation_m, solves many independent point
+    set pairs at once (e.g. all the registrations of a cohort or the bootstrap
+    samples of the fiducials) with a single batched SVD.
+    
+    Args:
+        points_in_left (numpy.ndarray): (B, N, 3) point sets corresponding to 
+                                        points_in_right in a different coordinate system.
+        points_in_right (numpy.ndarray): (B, N, 3) point sets corresponding to 
+                                         points_in_left in a different coordinate system.
+        weights (numpy.ndarray): optional (B, N) or (N,) non negative weight of 
+                                 each pair of points.
+        with_scale (boolean): also estimate an isotropic scale (similarity 
+                              transformation), as in Umeyama's paper.
+        
+    Returns:
+        R,t (numpy.ndarray, numpy.ndarray): (B, 3, 3) rotations and (B, 3) translations
+                                            that map points_in_left onto points_in_right,
+                                            s*R*points_in_left + t = points_in_right.
+        s (numpy.ndarray): (B,) scales, only returned if with_scale is True.
+    """
+    left = np.asarray(points_in_left, dtype=np.float64)
+    right = np.asarray(points_in_right, dtype=np.float64)
+    if left.ndim == 2:
+        left, right = left[np.newaxis], right[np.newaxis]
+
+    num_points, dim_points = left.shape[1], left.shape[2]
+    # Cursory check that the number of points is sufficient.
+    if num_points<dim_points:
+        raise ValueError('Number of points must be greater/equal {0}.'.format(dim_points))
+
+    if weights is None:
+        weights = np.ones(left.shape[:2])
+    weights = np.broadcast_to(np.asarray(weights, dtype=np.float64), left.shape[:2])
+    weights = weights / weights.sum(axis=1, keepdims=True)
+
+    # Center both data sets on the (weighted) mean.
+    left_mean = np.einsum('bn,bni->bi', weights, left)
+    right_mean = np.einsum('bn,bni->bi', weights, right)
+    left_M = left - left_mean[:, np.newaxis, :]
+    right_M = right - right_mean[:, np.newaxis, :]
+
+    M = np.einsum('bn,bni,bnj->bij', weights, left_M, right_M)
+    U,S,Vt = linalg.svd(M)
+    V = np.swapaxes(Vt, 1, 2)
+    # V * diag(1,1,det(U*V)) * U' - diagonal matrix ensures that we have a 
+    # rotation and not a reflection.
+    D = np.ones((len(M), dim_points))
+    D[:, -1] = linalg.det(np.matmul(U, V))
+    R = np.matmul(V * D[:, np.newaxis, :], np.swapaxes(U, 1, 2))
+
+    scale = np.ones(len(M))
+    if with_scale:
+        left_variance = np.einsum('bn,bni,bni->b', weights, left_M, left_M)
+        scale = (S * D).sum(axis=1) / left_variance
+
+    t = right_mean - scale[:, np.newaxis] * np.einsum('bij,bj->bi', R, left_mean)
+    if with_scale:
+        return R, t, scale
+    return R, t
+
+
+def generate_random_points(image, num_points):
+    """
+    Generate a random set (uniform sample) of points in the given image's domain.
+    
+    Args:
+        image (SimpleITK.Image): Domain in which points are created.
+        num_points (int): Number of points to generate.
+        
+    Returns:
+        numpy.ndarray: (num_points, dimension) array of physical points.
+    """
+    # Continous random uniform point indexes inside the image bounds.
+    point_indexes = np.random.random((num_points, image.GetDimension())) * np.array(image.GetSize())
+    return continuous_index_to_physical_points(image, point_indexes)
+
+
+def continuous_index_to_physical_points(image, point_indexes):
+    """
+    Array version of image.TransformContinuousIndexToPhysicalPoint.
+    
+    Args:
+        image (SimpleITK.Image): Image defining the physical space.
+        point_indexes (numpy.ndarray): (N, dimension) continuous indexes.
+        
+    Returns:
+        numpy.ndarray: (N, dimension) physical points.
+    """
+    dimension = image.GetDimension()
+    direction = np.array(image.GetDirection()).reshape(dimension, dimension)
+    return np.array(image.GetOrigin()) + (np.asarray(point_indexes) * np.array(image.GetSpacing())).dot(direction.T)
+
+
+def physical_points_to_continuous_index(image, points):
+    """
+    Array version of image.TransformPhysicalPointToContinuousIndex.
+    
+    Args:
+        image (SimpleITK.Image): Image defining the physical space.
+        points (numpy.ndarray): (N, dimension) physical points.
+        
+    Returns:
+        numpy.ndarray: (N, dimension) continuous indexes.
+    """
+    dimension = image.GetDimension()
+    direction = np.array(image.GetDirection()).reshape(dimension, dimension)
+    return (np.asarray(points) - np.array(image.GetOrigin())).dot(linalg.inv(direction).T) / np.array(image.GetSpacing())
+
+
 def generate_random_pointset(image, num_points):
     """
     Generate a random set (uniform sample) of points in the given image's domain.
@@ -90,17 +201,149 @@ def generate_random_pointset(image, num_points):
     Returns:
         A list of points (tuples).
     """
-    # Continous random uniform point indexes inside the image bounds.
-    point_indexes = np.multiply(np.tile(image.GetSize(), (num_points, 1)), 
-                                np.random.random((num_points, image.GetDimension())))
-    pointset_list = point_indexes.tolist()
-    # Get the list of physical points corresponding to the indexes.
-    return [image.TransformContinuousIndexToPhysicalPoint(point_index) \
-            for point_index in pointset_list]
+    return [tuple(point) for point in generate_random_points(image, num_points)]
+
+
+def linear_transform_parameters(tx):
+    """
+    Matrix A and translation b such that tx.TransformPoint(p) = A*p + b, if the
+    transform is linear (translation, Euler, versor, similarity, scale, affine,
+    or a composite of them).
+    
+    Args:
+        tx (SimpleITK.Transform): The transform.
+        
+    Returns:
+        (A, b) (numpy.ndarray, numpy.ndarray) or None if the transform is not linear.
+    """
+    tx = tx.Downcast() if hasattr(tx, 'Downcast') else tx
+    dimension = tx.GetDimension()
+
+    if isinstance(tx, sitk.CompositeTransform):
+        A = np.eye(dimension)
+        b = np.zeros(dimension)
+        # The last transform added is the first one applied to the points.
+        for index in range(tx.GetNumberOfTransforms()):
+            parameters = linear_transform_parameters(tx.GetNthTransform(index))
+            if parameters is None:
+                return None
+            A, b = A.dot(parameters[0]), A.dot(parameters[1]) + b
+        return A, b
+    if isinstance(tx, sitk.TranslationTransform):
+        return np.eye(dimension), np.array(tx.GetOffset())
+    if tx.GetName() == 'IdentityTransform':
+        return np.eye(dimension), np.zeros(dimension)
+    if hasattr(tx, 'GetMatrix') and hasattr(tx, 'GetCenter') and hasattr(tx, 'GetTranslation'):
+        A = np.array(tx.GetMatrix()).reshape(dimension, dimension)
+        center = np.array(tx.GetCenter())
+        return A, np.array(tx.GetTranslation()) + center - A.dot(center)
+    if hasattr(tx, 'GetMatrix'):
+        # E.g. ScaleTransform, it has no translation: A and b are computed from
+        # the transformed origin and axes.
+        b = np.array(tx.TransformPoint([0.0] * dimension))
+        A = np.array([tx.TransformPoint(axis) for axis in np.eye(dimension).tolist()]).T - b[:, np.newaxis]
+        return A, b
+    return None
+
+
+def transform_points(tx, points, reference_image=None):
+    """
+    Array version of tx.TransformPoint. Linear transforms are applied with a
+    single matrix product. Other transforms are sampled from their displacement 
+    field on the grid of the reference image (trilinear interpolation, points 
+    outside of the grid take the value of the closest border), if a reference
+    image is given, or transformed one point at a time.
+    
+    Args:
+        tx (SimpleITK.Transform): The transform.
+        points (numpy.ndarray): (N, dimension) points.
+        reference_image (SimpleITK.Image): Grid on which the displacement field
+                                           is computed for non linear transforms. The
+                                           cost grows with its number of pixels, use a 
+                                           grid coarser than the images (see coarse_grid).
+        
+    Returns:
+        numpy.ndarray: (N, dimension) transformed points.
+    """
+    points = np.asarray(points, dtype=np.float64)
+
+    parameters = linear_transform_parameters(tx)
+    if parameters is not None:
+        A, b = parameters
+        return points.dot(A.T) + b
+
+    if reference_image is None:
+        return np.array([tx.TransformPoint(point) for point in points.tolist()])
+
+    displacement_field = sitk.TransformToDisplacementField(tx,
+                                                           sitk.sitkVectorFloat64,
+                                                           reference_image.GetSize(),
+                                                           reference_image.GetOrigin(),
+                                                           reference_image.GetSpacing(),
+                                                           reference_image.GetDirection())
+    return points + sample_vector_image(displacement_field, points)
+
+
+def coarse_grid(image, factor=4):
+    """
+    Grid with the origin and direction of the image and a spacing about factor
+    times larger, going from the center of the first pixel to the center of the
+    last one, the domain of the transforms defined on the image (e.g. with
+    BSplineTransformInitializer). To be used as reference_image in transform_points.
+    
+    Args:
+        image (SimpleITK.Image): Image whose domain is covered.
+        factor (int): Ratio between the spacing of the grid and of the image.
+        
+    Returns:
+        SimpleITK.Image: Empty image defining the grid.
+    """
+    image_size = np.array(image.GetSize())
+    size = np.ceil((image_size - 1) / factor).astype(int) + 1
+    # The last grid point is on the center of the last pixel.
+    spacing = np.array(image.GetSpacing()) * (image_size - 1) / np.maximum(size - 1, 1)
+
+    grid = sitk.Image(size.tolist(), sitk.sitkUInt8)
+    grid.SetOrigin(image.GetOrigin())
+    grid.SetSpacing(spacing.tolist())
+    grid.SetDirection(image.GetDirection())
+    return grid
+
+
+def sample_vector_image(image, points):
+    """
+    Linear interpolation of a vector image (e.g. a displacement field) at the
+    given physical points, points outside of the grid take the value of the 
+    closest border.
+    
+    Args:
+        image (SimpleITK.Image): Vector image.
+        points (numpy.ndarray): (N, dimension) physical points.
+        
+    Returns:
+        numpy.ndarray: (N, components) interpolated values.
+    """
+    # Numpy indexes are in reverse order (z, y, x).
+    values = sitk.GetArrayViewFromImage(image)
+    dimension = image.GetDimension()
+    size = np.array(image.GetSize())
+
+    indexes = np.clip(physical_points_to_continuous_index(image, points), 0, size - 1)
+    lower = np.minimum(np.floor(indexes).astype(np.int64), np.maximum(size - 2, 0))
+    weights = indexes - lower
+
+    result = np.zeros((len(indexes), values.shape[-1]))
+    # Sum over the corners of the cell containing each point.
+    for corner in np.ndindex(*([2] * dimension)):
+        corner = np.array(corner)
+        corner_indexes = np.minimum(lower + corner, size - 1)
+        corner_weights = np.prod(np.where(corner, weights, 1 - weights), axis=1)
+        result += corner_weights[:, np.newaxis] * values[tuple(corner_indexes[:, ::-1].T)]
+    return result
 
 
 def registration_errors(tx, reference_fixed_point_list, reference_moving_point_list, 
-                        display_errors = False, figure_size=(8,6)):
+                        display_errors = False, figure_size=(8,6), reference_image=None):
   """
   Distances between points transformed by the given transformation and their
   location in another coordinate system. When the points are only used to 
@@ -109,21 +352,21 @@ def registration_errors(tx, reference_fixed_point_list, reference_moving_point_l
   
   Args:
       tx (SimpleITK.Transform): The transform we want to evaluate.
-      reference_fixed_point_list (list(tuple-like)): Points in fixed image 
-                                                     cooredinate system.
-      reference_moving_point_list (list(tuple-like)): Points in moving image 
-                                                      cooredinate system.
+      reference_fixed_point_list (list(tuple-like) or numpy.ndarray): Points in fixed image 
+                                                                       cooredinate system.
+      reference_moving_point_list (list(tuple-like) or numpy.ndarray): Points in moving image 
+                                                                        cooredinate system.
       display_points (boolean): Display a 3D figure with lines connecting 
                                 corresponding points.
+      reference_image (SimpleITK.Image): See transform_points.
 
   Returns:
-   (mean, std, min, max, errors) (float, float, float, float, [float]): 
+   (mean, std, min, max, errors) (float, float, float, float, numpy.ndarray): 
     TRE statistics and original TREs.
   """
-  transformed_fixed_point_list = [tx.TransformPoint(p) for p in reference_fixed_point_list]
+  transformed_fixed_points = transform_points(tx, reference_fixed_point_list, reference_image)
 
-  errors = [linalg.norm(np.array(p_fixed) -  np.array(p_moving))
-            for p_fixed,p_moving in zip(transformed_fixed_point_list, reference_moving_point_list)]
+  errors = linalg.norm(transformed_fixed_points - np.asarray(reference_moving_point_list, dtype=np.float64), axis=1)
   min_errors = np.min(errors)
   max_errors = np.max(errors)
   if display_errors:
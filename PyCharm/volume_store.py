@@ -0,0 +1,199 @@
+import gzip
+import json
+import os
+
+import numpy as np
+import SimpleITK as Sitk
+
+# Extensions of the files of a stored volume: raw array and geometry sidecar.
+RAW_EXTENSION = '.raw'
+HEADER_EXTENSION = '.json'
+
+# Extensions of the images converted by VolumeStore.convert_tree.
+IMAGE_EXTENSIONS = ('.nii', '.nii.gz', '.mha', '.mhd', '.nrrd')
+
+# Offset of the data in a single file NIfTI-1: 348 bytes of header and 4 of extension flags.
+NIFTI_OFFSET = 352
+# Compression of the .nii.gz files, higher levels are much slower for little gain.
+NIFTI_COMPRESS_LEVEL = 1
+
+
+# Removes the image extension from a file name.
+def strip_image_extension(name):
+    for extension in IMAGE_EXTENSIONS:
+        if name.endswith(extension):
+            return name[:-len(extension)]
+    return name
+
+
+# Returns True if the path is the sidecar of a stored volume.
+def is_store_path(path):
+    return path.endswith(HEADER_EXTENSION) and os.path.exists(path[:-len(HEADER_EXTENSION)] + RAW_EXTENSION)
+
+
+# Reads the header of a stored volume.
+def read_header(header_path):
+    with open(header_path) as header_file:
+        return json.load(header_file)
+
+
+# Opens the array of a stored volume as a read only memory map, nothing is
+# read from the disk until the array is accessed. Numpy order (z, y, x).
+def open_array(header_path):
+    header = read_header(header_path)
+    return np.memmap(header_path[:-len(HEADER_EXTENSION)] + RAW_EXTENSION,
+                     dtype=header['dtype'], mode='r', shape=tuple(header['shape']))
+
+
+# Returns the SimpleITK image of a stored volume, the data is copied once
+# from the memory map, without any decompression.
+def open_image(header_path, pixel_type=Sitk.sitkUnknown):
+    header = read_header(header_path)
+    image = Sitk.GetImageFromArray(open_array(header_path), isVector=header['components'] > 1)
+    image.SetOrigin(header['origin'])
+    image.SetSpacing(header['spacing'])
+    image.SetDirection(header['direction'])
+
+    if pixel_type != Sitk.sitkUnknown and image.GetPixelID() != pixel_type:
+        image = Sitk.Cast(image, pixel_type)
+    return image
+
+
+# Reads an image from a stored volume or from any file supported by SimpleITK.
+def read_image(path, pixel_type=Sitk.sitkUnknown):
+    if is_store_path(path):
+        return open_image(path, pixel_type)
+    return Sitk.ReadImage(path, pixel_type)
+
+
+# Returns the NIfTI affine (RAS) of an image with the given SimpleITK geometry
+# (LPS): the columns are the directions scaled by the spacing.
+def nifti_affine(origin, spacing, direction):
+    dimension = len(origin)
+    affine = np.eye(4)
+    affine[:dimension, :dimension] = np.reshape(direction, (dimension, dimension)) * np.asarray(spacing)
+    affine[:dimension, 3] = origin
+    # LPS to RAS, the first two axes are flipped.
+    affine[:2] *= -1
+    return affine
+
+
+# Writes a NIfTI file from a numpy array in SimpleITK order (z, y, x) with the
+# geometry of the image. The transposed view (x, y, z) of a C ordered array is
+# what NIfTI stores on disk, so the slices are written directly from the
+# buffer without any reorder copy, slab_slices at a time (all of them by
+# default), and the array can also be a memory map bigger than the memory.
+def write_nifti(array, output_path, origin=(0, 0, 0), spacing=(1, 1, 1), direction=(1, 0, 0, 0, 1, 0, 0, 0, 1),
+                slab_slices=None):
+    import nibabel as nib
+
+    if array.ndim != len(origin):
+        raise ValueError(f'Expected a {len(origin)}D array, got {array.shape}')
+    array = np.ascontiguousarray(array)
+
+    affine = nifti_affine(origin, spacing, direction)
+    header = nib.Nifti1Header()
+    header.set_data_shape(array.shape[::-1])
+    header.set_data_dtype(array.dtype)
+    header.set_zooms(tuple(spacing))
+    header.set_qform(affine, code=1)
+    header.set_sform(affine, code=1)
+    header.set_xyzt_units('mm')
+    header.set_data_offset(NIFTI_OFFSET)
+
+    slab_slices = slab_slices or len(array)
+    opener = gzip.open(output_path, 'wb', compresslevel=NIFTI_COMPRESS_LEVEL) if output_path.endswith('.gz') \
+        else open(output_path, 'wb')
+    with opener as nifti_file:
+        header.write_to(nifti_file)
+        nifti_file.write(b'\0' * (NIFTI_OFFSET - nifti_file.tell()))
+        for start in range(0, len(array), slab_slices):
+            nifti_file.write(memoryview(array[start:start + slab_slices]).cast('B'))
+
+    return output_path
+
+
+# Writes a SimpleITK image as NIfTI from its own buffer, see write_nifti.
+def write_image_nifti(image, output_path, slab_slices=None):
+    if image.GetNumberOfComponentsPerPixel() > 1:
+        raise ValueError('Only scalar images can be written with write_nifti')
+    return write_nifti(Sitk.GetArrayViewFromImage(image), output_path, image.GetOrigin(), image.GetSpacing(),
+                       image.GetDirection(), slab_slices)
+
+
+# Helper class that keeps a copy of the volumes as raw, uncompressed arrays
+# with a small json sidecar with the geometry, so that the notebooks and the
+# pipeline can open them with np.memmap instead of decompressing the
+# .nii.gz files at every access.
+class VolumeStore:
+
+    # Initialization method of the class.
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+    # Returns the path of the sidecar of a volume.
+    def header_path(self, name):
+        return os.path.join(self.store_dir, name + HEADER_EXTENSION)
+
+    # Writes a SimpleITK image in the store and returns the path of its sidecar.
+    def write(self, image, name):
+        header_path = self.header_path(name)
+        raw_path = header_path[:-len(HEADER_EXTENSION)] + RAW_EXTENSION
+        os.makedirs(os.path.dirname(header_path), exist_ok=True)
+
+        array = Sitk.GetArrayViewFromImage(image)
+        array.tofile(raw_path)
+
+        header = {'dtype': array.dtype.str,
+                  'shape': list(array.shape),
+                  'components': image.GetNumberOfComponentsPerPixel(),
+                  'origin': list(image.GetOrigin()),
+                  'spacing': list(image.GetSpacing()),
+                  'direction': list(image.GetDirection())}
+        # The sidecar is written last, a volume without it is incomplete.
+        with open(header_path, 'w') as header_file:
+            json.dump(header, header_file)
+
+        return header_path
+
+    # Converts an image file, unless the stored copy is newer than it.
+    # Returns the path of the sidecar.
+    def convert(self, image_path, name=None):
+        if name is None:
+            name = strip_image_extension(os.path.basename(image_path))
+
+        header_path = self.header_path(name)
+        if os.path.exists(header_path) and os.path.getmtime(header_path) >= os.path.getmtime(image_path):
+            return header_path
+
+        return self.write(Sitk.ReadImage(image_path), name)
+
+    # Converts all the images of a directory tree, keeping the same structure
+    # in the store. Returns the paths of the sidecars.
+    def convert_tree(self, root_dir):
+        header_paths = []
+
+        for dir_path, dir_names, file_names in os.walk(root_dir):
+            dir_names[:] = sorted(name for name in dir_names if not name.startswith('.'))
+            for file_name in sorted(file_names):
+                if file_name.endswith(IMAGE_EXTENSIONS):
+                    name = strip_image_extension(os.path.relpath(os.path.join(dir_path, file_name), root_dir))
+                    header_paths.append(self.convert(os.path.join(dir_path, file_name), name))
+
+        return header_paths
+
+    # Opens the array of a stored volume as a memory map.
+    def open_array(self, name):
+        return open_array(self.header_path(name))
+
+    # Returns the SimpleITK image of a stored volume.
+    def open_image(self, name, pixel_type=Sitk.sitkUnknown):
+        return open_image(self.header_path(name), pixel_type)
+
+    # Writes a stored volume as NIfTI, reading it from the memory map a slab at a time.
+    def export_nifti(self, name, output_path, slab_slices=16):
+        header = read_header(self.header_path(name))
+        if header['components'] > 1:
+            raise ValueError('Only scalar volumes can be written with write_nifti')
+        return write_nifti(self.open_array(name), output_path, header['origin'], header['spacing'],
+                           header['direction'], slab_slices)